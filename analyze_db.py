@@ -0,0 +1,290 @@
+#!/usr/bin/python
+"""Analyze_db reports what is inside a markov database.
+
+The database is streamed a chunk at a time and every statistic is kept in
+bounded memory, so chunked databases larger than RAM can be analyzed.
+Pickled databases have to be unpickled whole; convert them with
+db_converter.py first if they don't fit.
+"""
+import argparse
+import hashlib
+import heapq
+import logging
+import struct
+import sys
+
+import chainio
+
+from colortext import *
+
+#
+
+ARGPARSER = argparse.ArgumentParser(description='Analyze a database.')
+ARGPARSER.add_argument('--db', dest='db', default='./charrakdb')
+ARGPARSER.add_argument('--format', dest='fmt', default=None,
+                       choices=chainio.FORMATS,
+                       help='Database format (default: detect)')
+ARGPARSER.add_argument('--threads', dest='threads', type=int,
+                       default=chainio.THREADS)
+ARGPARSER.add_argument('--chunk_size', dest='chunk_size', type=int,
+                       default=chainio.CHUNK_SIZE)
+ARGPARSER.add_argument('--top', dest='top', type=int, default=20,
+                       help='How many hub contexts to list')
+ARGPARSER.add_argument('--prune', dest='prune', default='1,2,3,5,10',
+                       help='Comma separated count thresholds to evaluate')
+ARGPARSER.add_argument('--sketch_size', dest='sketch_size', type=int,
+                       default=4096,
+                       help='Hashes kept to estimate the vocabulary size')
+ARGS = ARGPARSER.parse_args()
+
+#
+
+# Sizes of the objects a loaded MarkovChain is built from.
+TUPLE_SIZE = sys.getsizeof(('', ''))
+PAIR_SIZE = sys.getsizeof([0, ''])
+INT_SIZE = sys.getsizeof(2**20)
+EMPTY_LIST_SIZE = sys.getsizeof([])
+POINTER_SIZE = struct.calcsize('P')
+EMPTY_DICT_SIZE = sys.getsizeof({})
+DICT_ENTRY_SIZE = 3 * POINTER_SIZE
+
+# Small ints are shared by the interpreter and cost nothing per use.
+SHARED_INTS = 256
+
+
+def dictBytes(entries):
+    # Dicts keep at least a third of their table free.
+    table = 8
+    while table * 2 <= entries * 3:
+        table *= 2
+    return EMPTY_DICT_SIZE + (table - 8) * DICT_ENTRY_SIZE
+
+
+def listBytes(entries):
+    # Lists grown by append over-allocate by about an eighth.
+    if not entries:
+        return EMPTY_LIST_SIZE
+    return EMPTY_LIST_SIZE + POINTER_SIZE * (entries + (entries >> 3) + 6)
+
+
+def bucket(value):
+    """Returns the power of two bucket holding value: 1, 2-3, 4-7, ..."""
+    bits = 0
+    while value >> (bits + 1):
+        bits += 1
+    return bits
+
+
+def bucketLabel(bits):
+    low, high = 1 << bits, (1 << (bits + 1)) - 1
+    if low == high:
+        return str(low)
+    return '%d-%d' % (low, high)
+
+
+class DistinctSketch(object):
+    """Estimates the number of distinct strings seen (k minimum values).
+
+    Only the k smallest 64 bit hashes are kept; if they spread over a
+    fraction f of the hash space, about (k - 1) / f distinct values were
+    seen.  Below k distinct values the count is exact.
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self._heap = [] # negated, so the largest kept hash is on top
+        self._kept = set()
+
+    def add(self, text):
+        value = struct.unpack('<Q', hashlib.md5(text).digest()[:8])[0]
+        if value in self._kept:
+            return
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, -value)
+            self._kept.add(value)
+        elif value < -self._heap[0]:
+            self._kept.discard(-heapq.heapreplace(self._heap, -value))
+            self._kept.add(value)
+
+    def estimate(self):
+        if len(self._heap) < self.k:
+            return len(self._heap)
+        return int((self.k - 1) / (float(-self._heap[0]) / 2**64))
+
+
+class Analysis(object):
+    """Accumulates statistics over a stream of (key, successors) chunks."""
+
+    def __init__(self, top, thresholds, sketch_size):
+        self.contexts = 0
+        self.transitions = 0
+        self.mass = 0
+        self.fanout = {} # bucket -> contexts
+        self.counts = {} # bucket -> transitions
+        self.vocabulary = DistinctSketch(sketch_size)
+        # MarkovChain.word_index has a list per word appearing in a context.
+        self.context_words = DistinctSketch(sketch_size)
+        self.index_entries = 0
+        self.top = top
+        self.hubs = [] # min-heap of (fan-out, mass, key)
+
+        self.memory = dict.fromkeys(
+            ['keys', 'successor lists', 'pairs', 'counts', 'words'], 0)
+
+        self.thresholds = thresholds
+        # threshold -> [transitions, contexts, mass, bytes] removed
+        self.pruned = dict((threshold, [0, 0, 0, 0])
+                           for threshold in thresholds)
+
+    def update(self, chunk):
+        for key, successors in chunk:
+            self.contexts += 1
+            fanout = len(successors)
+            self.transitions += fanout
+            self.fanout[bucket(fanout)] = self.fanout.get(
+                bucket(fanout), 0) + 1
+            for word in key:
+                self.vocabulary.add(word)
+            indexed = len(set(word for word in key if word))
+            self.index_entries += indexed
+            for word in key:
+                if word:
+                    self.context_words.add(word)
+
+            key_bytes = TUPLE_SIZE + sum(sys.getsizeof(word) for word in key)
+            list_bytes = EMPTY_LIST_SIZE + POINTER_SIZE * fanout
+            self.memory['keys'] += key_bytes
+            self.memory['successor lists'] += list_bytes
+            self.memory['pairs'] += PAIR_SIZE * fanout
+
+            mass = 0
+            small = [] # (count, bytes) of each transition, for pruning
+            for count, word in successors:
+                mass += count
+                self.counts[bucket(count)] = self.counts.get(
+                    bucket(count), 0) + 1
+                self.vocabulary.add(word)
+                word_bytes = sys.getsizeof(word)
+                int_bytes = INT_SIZE if count > SHARED_INTS else 0
+                self.memory['words'] += word_bytes
+                self.memory['counts'] += int_bytes
+                if count <= self.thresholds[-1]:
+                    small.append((count, PAIR_SIZE + POINTER_SIZE +
+                                  word_bytes + int_bytes))
+            self.mass += mass
+
+            for threshold in self.thresholds:
+                removed, removed_mass, removed_bytes = 0, 0, 0
+                for count, transition_bytes in small:
+                    if count <= threshold:
+                        removed += 1
+                        removed_mass += count
+                        removed_bytes += transition_bytes
+                totals = self.pruned[threshold]
+                totals[0] += removed
+                totals[2] += removed_mass
+                if removed == fanout:
+                    # Nothing left to follow, so the context goes too.
+                    totals[1] += 1
+                    totals[3] += (key_bytes + EMPTY_LIST_SIZE + removed_bytes +
+                                  POINTER_SIZE * (1 + indexed))
+                else:
+                    totals[3] += removed_bytes
+
+            hub = (fanout, mass, key)
+            if len(self.hubs) < self.top:
+                heapq.heappush(self.hubs, hub)
+            elif hub > self.hubs[0]:
+                heapq.heapreplace(self.hubs, hub)
+
+    def structureMemory(self):
+        """Returns the estimated bytes of each structure, by name."""
+        memory = dict(self.memory)
+        memory['dict table'] = dictBytes(self.contexts)
+        # MarkovChain.contexts and word_index, for random and seed contexts.
+        memory['context list'] = listBytes(self.contexts)
+        words = self.context_words.estimate()
+        memory['word index'] = (dictBytes(words) + words * EMPTY_LIST_SIZE +
+                                POINTER_SIZE * self.index_entries * 9 // 8)
+        return memory
+
+    def totalMemory(self):
+        return sum(self.structureMemory().values())
+
+    def report(self, out):
+        def mb(size):
+            return '%.1f MB' % (size / (1024.0 * 1024.0))
+
+        def percent(part, whole):
+            return '%.1f%%' % (100.0 * part / whole if whole else 0.0)
+
+        out.write('Contexts (bigrams):   %d\n' % self.contexts)
+        out.write('Transitions:          %d\n' % self.transitions)
+        out.write('Total count:          %d\n' % self.mass)
+        out.write('Vocabulary (approx):  %d\n' % self.vocabulary.estimate())
+        if self.contexts:
+            out.write('Mean fan-out:         %.2f\n' %
+                      (float(self.transitions) / self.contexts))
+
+        out.write('\nFan-out distribution (successors per context):\n')
+        for bits in sorted(self.fanout):
+            out.write('  %12s  %10d  %6s\n' % (
+                bucketLabel(bits), self.fanout[bits],
+                percent(self.fanout[bits], self.contexts)))
+
+        out.write('\nCount histogram (transitions by count):\n')
+        for bits in sorted(self.counts):
+            out.write('  %12s  %10d  %6s\n' % (
+                bucketLabel(bits), self.counts[bits],
+                percent(self.counts[bits], self.transitions)))
+
+        memory = self.structureMemory()
+        out.write('\nEstimated memory once loaded (words counted as '
+                  'unshared, so an upper bound):\n')
+        for name in sorted(memory):
+            out.write('  %-16s %12s\n' % (name, mb(memory[name])))
+        out.write('  %-16s %12s\n' % ('total', mb(sum(memory.values()))))
+
+        out.write('\nTop %d hub contexts:\n' % len(self.hubs))
+        for fanout, mass, key in sorted(self.hubs, reverse=True):
+            out.write('  %8d successors  %10d count  %r\n' % (
+                fanout, mass, ' '.join(key)))
+
+        out.write('\nPruning transitions with count <= threshold would '
+                  'remove:\n')
+        for threshold in self.thresholds:
+            removed, contexts, mass, size = self.pruned[threshold]
+            out.write('  <= %-4d %10d transitions (%s), %10d contexts (%s), '
+                      '%s of the count, about %s\n' % (
+                          threshold, removed,
+                          percent(removed, self.transitions), contexts,
+                          percent(contexts, self.contexts),
+                          percent(mass, self.mass),
+                          mb(size + dictBytes(self.contexts) -
+                             dictBytes(self.contexts - contexts))))
+
+
+logging.getLogger().setLevel(logging.INFO)
+
+DB = str(ARGS.db)
+THRESHOLDS = sorted(set(int(threshold)
+                        for threshold in ARGS.prune.split(',') if threshold))
+if not THRESHOLDS:
+    THRESHOLDS = [0]
+
+ANALYSIS = Analysis(ARGS.top, THRESHOLDS, ARGS.sketch_size)
+PROGRESS = chainio.Progress('Analyzing')
+
+try:
+    CHUNKS = chainio.readChunks(DB, ARGS.fmt, ARGS.chunk_size, ARGS.threads)
+    for _ in chainio.tee(CHUNKS, PROGRESS, ANALYSIS):
+        pass
+except IOError:
+    logging.error('Unable to read database file "%s"', DB)
+    sys.exit(1)
+except ValueError:
+    logging.error('Database "%s" corrupt or unreadable', DB)
+    sys.exit(2)
+PROGRESS.report()
+
+ANALYSIS.report(sys.stdout)
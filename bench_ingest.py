@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""Compares per-line, batched and bulk training throughput.
+
+Trains fresh chains from the given log files (or a synthetic corpus) with
+MarkovChain.addLine, with an ingest session and, if numpy is installed,
+with a bulkcount.BulkSession, and reports lines/sec.
+"""
+import argparse
+import random
+import tempfile
+import time
+import os
+
+import bulkcount
+import markov
+
+ARGPARSER = argparse.ArgumentParser(description='Benchmark chain training.')
+ARGPARSER.add_argument('files', nargs='*')
+ARGPARSER.add_argument('--lines', dest='lines', type=int, default=200000,
+                       help='Size of the synthetic corpus')
+ARGPARSER.add_argument('--vocabulary', dest='vocabulary', type=int,
+                       default=5000)
+ARGPARSER.add_argument('--batch', dest='batch', type=int,
+                       default=markov.INGEST_BATCH)
+ARGPARSER.add_argument('--bulk_batch', dest='bulk_batch', type=int,
+                       default=bulkcount.BULK_BATCH)
+ARGS = ARGPARSER.parse_args()
+
+#
+
+
+def synthetic(lines, vocabulary):
+    # Roughly Zipfian word frequencies, like chat.
+    random.seed(0)
+    words = ['w%d' % ii for ii in range(vocabulary)]
+    corpus = []
+    for _ in xrange(lines):
+        length = random.randint(2, 16)
+        corpus.append(' '.join(
+            words[min(int(random.paretovariate(1.1)) - 1, vocabulary - 1)]
+            for _ in range(length)))
+    return corpus
+
+
+def emptyChain():
+    # A path that doesn't exist, so the chain starts empty.
+    return markov.MarkovChain(os.path.join(tempfile.mkdtemp(), 'benchdb'))
+
+
+def normalized(db):
+    return dict((key, sorted((w, c) for c, w in value))
+                for key, value in db.iteritems())
+
+
+def timeIt(label, train, corpus):
+    chain = emptyChain()
+    start = time.time()
+    train(chain, corpus)
+    elapsed = time.time() - start
+    print '%-10s %8.2fs %12.0f lines/s' % (label, elapsed,
+                                           len(corpus) / elapsed)
+    return chain
+
+
+def perLine(chain, corpus):
+    for line in corpus:
+        chain.addLine(line)
+
+
+def batched(chain, corpus):
+    with chain.ingestSession(ARGS.batch) as session:
+        for line in corpus:
+            session.addLine(line)
+
+
+def bulk(chain, corpus):
+    with bulkcount.BulkSession(chain, ARGS.bulk_batch) as session:
+        for line in corpus:
+            session.addLine(line)
+
+
+if ARGS.files:
+    CORPUS = []
+    for fi in ARGS.files:
+        with open(fi) as f:
+            CORPUS.extend(line.rstrip('\n') for line in f)
+else:
+    CORPUS = synthetic(ARGS.lines, ARGS.vocabulary)
+
+print '%d lines' % len(CORPUS)
+BASELINE = timeIt('addLine', perLine, CORPUS)
+BATCHED = timeIt('batched', batched, CORPUS)
+EXPECTED = normalized(BASELINE.db)
+if normalized(BATCHED.db) != EXPECTED:
+    print 'MISMATCH: batched training produced different counts'
+if bulkcount.np is not None:
+    BULK = timeIt('bulk', bulk, CORPUS)
+    if normalized(BULK.db) != EXPECTED:
+        print 'MISMATCH: bulk training produced different counts'
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""Measures how learning and replies scale with --partitions.
+
+Trains an in-process MarkovChain and PartitionedChains with each number of
+shards from the given log files (or a synthetic corpus), then generates
+replies from the same seeds, and reports lines/sec and replies/sec, with
+the CPU time learning costs the bot's own process per line.  The shards'
+saved databases are checked against the in-process one.
+
+Every shard tokenizes every line, so shards only add throughput with
+spare cores; see the cpu count in the first line.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import chainio
+import markov
+import partition
+
+ARGPARSER = argparse.ArgumentParser(description='Benchmark partitions.')
+ARGPARSER.add_argument('files', nargs='*')
+ARGPARSER.add_argument('--lines', dest='lines', type=int, default=100000,
+                       help='Size of the synthetic corpus')
+ARGPARSER.add_argument('--vocabulary', dest='vocabulary', type=int,
+                       default=5000)
+ARGPARSER.add_argument('--shards', dest='shards', default='2,4',
+                       help='Comma separated shard counts to try')
+ARGPARSER.add_argument('--batch', dest='batch', type=int, default=64)
+ARGPARSER.add_argument('--replies', dest='replies', type=int, default=2000)
+ARGS = ARGPARSER.parse_args()
+
+#
+
+
+def synthetic(lines, vocabulary):
+    # Roughly Zipfian word frequencies, like chat.
+    random.seed(0)
+    words = ['w%d' % ii for ii in range(vocabulary)]
+    corpus = []
+    for _ in xrange(lines):
+        length = random.randint(2, 16)
+        corpus.append(' '.join(
+            words[min(int(random.paretovariate(1.1)) - 1, vocabulary - 1)]
+            for _ in range(length)))
+    return corpus
+
+
+def normalized(db):
+    return dict((key, sorted((w, c) for c, w in value))
+                for key, value in db.iteritems())
+
+
+def merged(paths):
+    db = {}
+    for path in paths:
+        db.update(chainio.load(path))
+    return db
+
+
+def cpu():
+    # This process only, not the shards.
+    times = os.times()
+    return times[0] + times[1]
+
+
+def run(label, chain, corpus, seeds):
+    start = time.time()
+    start_cpu = cpu()
+    for line in corpus:
+        chain.addLine(line)
+    chain.flush()
+    # size() waits for the shards to finish what they were sent.
+    chain.size()
+    learned = time.time() - start
+    learned_cpu = cpu() - start_cpu
+
+    random.seed(1)
+    start = time.time()
+    words = 0
+    for seed in seeds:
+        words += len(chain.respond(seed).split())
+    replied = time.time() - start
+
+    print ('%-12s %10.0f lines/s %8.1fus cpu/line %8.0f replies/s '
+           '%10.0f words/s' % (label, len(corpus) / learned,
+                               1e6 * learned_cpu / len(corpus),
+                               len(seeds) / replied, words / replied))
+
+
+class InProcess(markov.MarkovChain):
+    def flush(self):
+        pass
+
+
+logging.getLogger().setLevel(logging.ERROR)
+
+if ARGS.files:
+    CORPUS = []
+    for fi in ARGS.files:
+        with open(fi) as f:
+            CORPUS.extend(line.rstrip('\n') for line in f)
+else:
+    CORPUS = synthetic(ARGS.lines, ARGS.vocabulary)
+
+print '%d lines, %d cpus' % (len(CORPUS), multiprocessing.cpu_count())
+TEMP = tempfile.mkdtemp()
+try:
+    # Every chain replies from the same seeds, known to all of them.
+    random.seed(2)
+    SEEDS = [bigram for line in random.sample(CORPUS, ARGS.replies)
+             for bigram, _ in markov.transitions(line)[:1]]
+    BASELINE = InProcess(os.path.join(TEMP, 'benchdb'), load=False)
+    run('in-process', BASELINE, CORPUS, SEEDS)
+    EXPECTED = normalized(BASELINE.db)
+
+    for shards in [int(n) for n in ARGS.shards.split(',')]:
+        path = os.path.join(TEMP, 'benchdb%d' % shards)
+        CHAIN = partition.PartitionedChain(path, shards, ARGS.batch)
+        try:
+            run('%d shards' % shards, CHAIN, CORPUS, SEEDS)
+            CHAIN.saveDatabase()
+        finally:
+            CHAIN.close()
+        if normalized(merged(CHAIN.shardPaths)) != EXPECTED:
+            print 'MISMATCH: %d shards learned different counts' % shards
+finally:
+    shutil.rmtree(TEMP)
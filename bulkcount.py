@@ -0,0 +1,129 @@
+"""Bulkcount counts a corpus's transitions with NumPy instead of per line.
+
+A BulkSession is a drop-in replacement for markov.IngestSession for full
+retrains.  It buffers lines, and for every batch:
+  - tokenizes all of them exactly as markov.transitions does, into one
+    stream of word ids with a separator id between sentences,
+  - forms (first, second, next) triples from three shifted views of the
+    stream, dropping those that straddle a separator,
+  - sorts the triples, packed into single integers when the vocabulary
+    allows, and counts the runs,
+and hands the counts to the chain's addCounts.
+
+NumPy is optional; without it np is None and BulkSession can't be used.
+"""
+
+import itertools
+
+from collections import defaultdict
+
+import markov
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# How many lines a BulkSession counts at once.
+BULK_BATCH = 200000
+
+# parseLineIntoSentences strips '#', so it can never be a word and safely
+# marks the end of a sentence in the token stream.
+SEPARATOR = '#'
+
+
+class BulkSession(object):
+    """Counts transitions in large vectorized batches.
+
+    Learns exactly what markov.IngestSession would from the same lines.
+    """
+
+    def __init__(self, chain, batch_size=BULK_BATCH):
+        if np is None:
+            raise ImportError('BulkSession needs numpy')
+        self.chain = chain
+        self.batch_size = batch_size
+        self.lines = 0
+        self._pending = []
+        # Looking up a new word gives it the next id, without a Python
+        # level branch per token.
+        self._ids = defaultdict(itertools.count().next)
+        self._ids[SEPARATOR]
+        self._words = [SEPARATOR]
+
+    def addLine(self, line):
+        self._pending.append(line)
+        self.lines += 1
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def _tokenize(self, lines):
+        sentences = []
+        for line in lines:
+            sentences.extend(markov.parseLineIntoSentences(line))
+        # Tokens are split on single spaces, empty ones included, just as
+        # markov.bigrams does.
+        tokens = (' %s ' % SEPARATOR).join(sentences).split(' ')
+        ids = np.fromiter(itertools.imap(self._ids.__getitem__, tokens),
+                          dtype=np.int32, count=len(tokens))
+
+        if len(self._words) < len(self._ids):
+            words = self._words + [None] * (len(self._ids) - len(self._words))
+            for word, wid in self._ids.iteritems():
+                if wid >= len(self._words):
+                    words[wid] = word
+            self._words = words
+        return ids
+
+    def _count(self, ids):
+        separator = self._ids[SEPARATOR]
+        first, second, following = ids[:-2], ids[1:-1], ids[2:]
+        keep = ((first != separator) & (second != separator) &
+                (following != separator))
+        first, second, following = first[keep], second[keep], following[keep]
+        if not len(first):
+            return first, second, following, np.zeros(0, dtype=np.int64)
+
+        words = len(self._ids)
+        if words ** 3 < 2 ** 63:
+            # Pack each triple into one int64; sorting one key is several
+            # times faster than lexsorting three.
+            keys = ((first.astype(np.int64) * words + second) * words +
+                    following)
+            keys, counts = np.unique(keys, return_counts=True)
+            keys, following = np.divmod(keys, words)
+            first, second = np.divmod(keys, words)
+            return first, second, following, counts
+
+        order = np.lexsort((following, second, first))
+        first, second = first[order], second[order]
+        following = following[order]
+
+        starts = np.ones(len(first), dtype=bool)
+        starts[1:] = ((first[1:] != first[:-1]) |
+                      (second[1:] != second[:-1]) |
+                      (following[1:] != following[:-1]))
+        starts = np.flatnonzero(starts)
+        counts = np.diff(np.append(starts, len(first)))
+        return first[starts], second[starts], following[starts], counts
+
+    def _emit(self, first, second, following, counts):
+        words = self._words
+        for a, b, c, count in itertools.izip(first.tolist(), second.tolist(),
+                                             following.tolist(),
+                                             counts.tolist()):
+            yield ((words[a], words[b]), words[c]), count
+
+    def flush(self):
+        if self._pending:
+            ids = self._tokenize(self._pending)
+            self._pending = []
+            counted = self._count(ids)
+            if len(counted[3]):
+                self.chain.addCounts(self._emit(*counted))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *unused_exc):
+        self.flush()
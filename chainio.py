@@ -0,0 +1,421 @@
+"""Chainio reads and writes markov databases as streams of items.
+
+A database is a dict of (word, word) -> [[count, word], ...].  Readers yield
+it in chunks of (key, successors) items and writers consume such chunks, so
+a database can move between formats without both copies being in memory.
+
+Supported formats:
+  legacy   a pickled tuple whose first element is the database
+  pickle   a pickled database
+  chunked  a container of independently compressed, pickled chunks followed
+           by an index of their offsets, so it can be written and read one
+           chunk at a time and (de)compressed by several threads at once
+
+The chunked layout is:
+  MAGIC, version byte, codec name length byte, codec name
+  compressed chunks, each a pickled list of items
+  pickled index of (offset, length, items) per chunk
+  footer: index offset and length as little-endian uint64s, then MAGIC
+
+With NumPy installed there is also:
+  npz      a columnar.Table of flat word id and count arrays, which can be
+           merged without unpickling into dicts (see merge_dbs.py)
+"""
+
+import hashlib
+import itertools
+import logging
+import os
+import random
+import struct
+import time
+import zlib
+
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+import columnar
+from colortext import *
+
+try:
+    # use cPickle when using python2 for better performance
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+FORMATS = ('legacy', 'pickle', 'chunked')
+if columnar.np is not None:
+    FORMATS += ('npz',)
+
+# Codecs for the chunked format: name -> (compress, decompress).  zlib and
+# lzma release the GIL while they work, so threads compress in parallel.
+CODECS = {
+    'none': (lambda data: data, lambda data: data),
+    'zlib': (lambda data: zlib.compress(data, 6), zlib.decompress),
+}
+if lzma:
+    CODECS['lzma'] = (lzma.compress, lzma.decompress)
+
+MAGIC = 'CHRKCHNK'
+_ZIP_MAGIC = 'PK\x03\x04'
+VERSION = 1
+_FOOTER = struct.Struct('<QQ8s')
+
+# Threads used to (de)compress chunks.
+THREADS = 4
+
+# Number of items per chunk
+CHUNK_SIZE = 10000
+
+# Raw pickle opcodes used to write a dict incrementally.
+_PROTO = '\x80\x02'
+_EMPTY_DICT = '}'
+_MARK = '('
+_SETITEMS = 'u'
+_TUPLE1 = '\x85'
+_STOP = '.'
+
+
+def _loadPickle(path, fmt):
+    with open(path, 'rb') as dbfile:
+        db = pickle.load(dbfile)
+    if fmt == 'legacy':
+        db = db[0]
+    return db
+
+
+def _chunksOfDict(db, chunk_size):
+    # Pop items as they are handed out so the source shrinks as the
+    # destination grows.
+    while db:
+        chunk = []
+        while db and len(chunk) < chunk_size:
+            chunk.append(db.popitem())
+        yield chunk
+
+
+def detectFormat(path):
+    """Returns 'chunked', 'npz' or 'pickle'.
+
+    Legacy pickles can't be told apart from pickles.
+    """
+    with open(path, 'rb') as dbfile:
+        magic = dbfile.read(len(MAGIC))
+    if magic == MAGIC:
+        return 'chunked'
+    if magic.startswith(_ZIP_MAGIC):
+        return 'npz'
+    return 'pickle'
+
+
+def _ordered(pool, function, args, ahead):
+    # Like pool.imap, but never more than ahead results outstanding, so
+    # only a few chunks are held in memory at once.
+    pending = deque()
+    for arg in args:
+        pending.append(pool.apply_async(function, (arg,)))
+        if len(pending) >= ahead:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def _readChunked(path, threads):
+    with open(path, 'rb') as dbfile:
+        if dbfile.read(len(MAGIC)) != MAGIC:
+            raise ValueError('"%s" is not a chunked database' % path)
+        version, name_length = struct.unpack('<BB', dbfile.read(2))
+        if version != VERSION:
+            raise ValueError('Unsupported chunked database version %d' %
+                             version)
+        codec = dbfile.read(name_length)
+        if codec not in CODECS:
+            raise ValueError('Unsupported codec "%s"' % codec)
+        decompress = CODECS[codec][1]
+
+        dbfile.seek(-_FOOTER.size, os.SEEK_END)
+        index_offset, index_length, magic = _FOOTER.unpack(
+            dbfile.read(_FOOTER.size))
+        if magic != MAGIC:
+            raise ValueError('"%s" is truncated' % path)
+        dbfile.seek(index_offset)
+        index = pickle.loads(dbfile.read(index_length))
+
+        def compressed():
+            for offset, length, _ in index:
+                dbfile.seek(offset)
+                yield dbfile.read(length)
+
+        def load(data):
+            try:
+                return decompress(data)
+            except Exception as e:
+                raise ValueError('Corrupt chunk in "%s": %s' % (path, e))
+
+        pool = ThreadPool(threads)
+        try:
+            for data in _ordered(pool, load, compressed(), 2 * threads):
+                yield pickle.loads(data)
+        finally:
+            pool.terminate()
+
+
+def readChunks(path, fmt=None, chunk_size=CHUNK_SIZE, threads=THREADS):
+    """Yields lists of (key, successors) items from the database at path.
+
+    fmt defaults to whatever detectFormat finds.  Chunked databases are
+    yielded in the chunks they were written with.
+    """
+    if fmt is None:
+        fmt = detectFormat(path)
+    if fmt not in FORMATS:
+        raise ValueError('Unknown database format "%s"' % fmt)
+    if fmt == 'chunked':
+        return _readChunked(path, threads)
+    if fmt == 'npz':
+        return columnar.toChunks(columnar.load(path), chunk_size)
+    return _chunksOfDict(_loadPickle(path, fmt), chunk_size)
+
+
+def _pickleBody(obj):
+    # The opcodes that push obj, without the protocol header and STOP.
+    # Each call has its own memo; reusing memo slots is harmless because
+    # every reference is resolved before the next object is written.
+    data = pickle.dumps(obj, 2)
+    return data[len(_PROTO):-len(_STOP)]
+
+
+def _writePickle(dbfile, chunks, fmt):
+    count = 0
+    dbfile.write(_PROTO + _EMPTY_DICT)
+    for chunk in chunks:
+        if not chunk:
+            continue
+        dbfile.write(_MARK)
+        for key, successors in chunk:
+            dbfile.write(_pickleBody(key))
+            dbfile.write(_pickleBody(successors))
+        dbfile.write(_SETITEMS)
+        count += len(chunk)
+    if fmt == 'legacy':
+        dbfile.write(_TUPLE1)
+    dbfile.write(_STOP)
+    return count
+
+
+class ChunkWriter(object):
+    """Writes a chunked database incrementally.
+
+    Chunks passed to write() are pickled straight away and compressed by a
+    pool of threads; close() waits for them and writes the index.
+    """
+
+    def __init__(self, path, codec='zlib', threads=THREADS):
+        if codec not in CODECS:
+            raise ValueError('Unsupported codec "%s"' % codec)
+        self.items = 0
+        self._compress = CODECS[codec][0]
+        self._index = []
+        self._pending = deque()
+        self._ahead = 2 * threads
+        self._pool = ThreadPool(threads)
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC + struct.pack('<BB', VERSION, len(codec)) +
+                         codec)
+
+    def write(self, chunk):
+        if not chunk:
+            return
+        data = pickle.dumps(chunk, 2)
+        self._pending.append(
+            (len(chunk), self._pool.apply_async(self._compress, (data,))))
+        while len(self._pending) >= self._ahead:
+            self._writeOne()
+
+    def _writeOne(self):
+        items, result = self._pending.popleft()
+        data = result.get()
+        self._index.append((self._file.tell(), len(data), items))
+        self._file.write(data)
+        self.items += items
+
+    def close(self):
+        try:
+            while self._pending:
+                self._writeOne()
+            index = pickle.dumps(self._index, 2)
+            index_offset = self._file.tell()
+            self._file.write(index)
+            self._file.write(_FOOTER.pack(index_offset, len(index), MAGIC))
+        finally:
+            self._pool.terminate()
+            self._file.close()
+
+
+def writeChunks(path, chunks, fmt='pickle', codec='zlib', threads=THREADS):
+    """Writes chunks of items to path and returns the number written."""
+    if fmt not in FORMATS:
+        raise ValueError('Unknown database format "%s"' % fmt)
+    if fmt == 'chunked':
+        writer = ChunkWriter(path, codec, threads)
+        try:
+            for chunk in chunks:
+                writer.write(chunk)
+        finally:
+            writer.close()
+        return writer.items
+    if fmt == 'npz':
+        table = columnar.fromChunks(chunks)
+        with open(path, 'wb') as dbfile:
+            columnar.save(dbfile, table, codec != 'none')
+        return table.size()
+    with open(path, 'wb') as dbfile:
+        return _writePickle(dbfile, chunks, fmt)
+
+
+def load(path, fmt=None):
+    """Returns the whole database at path as a dict."""
+    if fmt is None:
+        fmt = detectFormat(path)
+    if fmt in ('pickle', 'legacy'):
+        # The unpickled dict is the database; nothing to gain by chunking.
+        return _loadPickle(path, fmt)
+    db = {}
+    for chunk in readChunks(path, fmt):
+        db.update(chunk)
+    return db
+
+
+def save(path, db, fmt='pickle', codec='zlib'):
+    """Writes a whole database dict to path and returns its size."""
+    if fmt in ('pickle', 'legacy'):
+        # One dump is faster and smaller than pickling item by item.
+        if fmt == 'legacy':
+            obj = (db,)
+        else:
+            obj = db
+        with open(path, 'wb') as dbfile:
+            pickle.dump(obj, dbfile, 2)
+        return len(db)
+    return writeChunks(path, chunked(db.iteritems()), fmt, codec)
+
+
+def chunked(items, chunk_size=CHUNK_SIZE):
+    """Groups an iterable of items into lists of chunk_size."""
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def itemDigest(key, successors):
+    """Returns a 64 bit digest of an item, independent of successor order."""
+    normal = (key, sorted((word, count) for count, word in successors))
+    return struct.unpack('<Q', hashlib.md5(repr(normal)).digest()[:8])[0]
+
+
+class Checksum(object):
+    """An order independent checksum over a stream of items."""
+
+    def __init__(self):
+        self.items = 0
+        self.transitions = 0
+        self.digest = 0
+
+    def update(self, chunk):
+        for key, successors in chunk:
+            self.items += 1
+            self.transitions += len(successors)
+            self.digest = (self.digest + itemDigest(key, successors)) % 2**64
+
+    def __eq__(self, other):
+        return (self.items, self.transitions, self.digest) == (
+            other.items, other.transitions, other.digest)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __str__(self):
+        return '%d contexts, %d transitions, digest %016x' % (
+            self.items, self.transitions, self.digest)
+
+
+class Sample(object):
+    """A reservoir sample of items, for spot-checking a copy."""
+
+    def __init__(self, size):
+        self.size = size
+        self.seen = 0
+        self.items = {}
+        self._keys = []
+
+    def update(self, chunk):
+        for key, successors in chunk:
+            self.seen += 1
+            if len(self._keys) < self.size:
+                self._keys.append(key)
+            else:
+                which = random.randint(0, self.seen - 1)
+                if which >= self.size:
+                    continue
+                del self.items[self._keys[which]]
+                self._keys[which] = key
+            self.items[key] = itemDigest(key, successors)
+
+    def mismatches(self, chunks):
+        """Returns the number of sampled items missing or different."""
+        remaining = dict(self.items)
+        bad = 0
+        for chunk in chunks:
+            for key, successors in chunk:
+                digest = remaining.pop(key, None)
+                if digest is not None and digest != itemDigest(key,
+                                                               successors):
+                    bad += 1
+        return bad + len(remaining)
+
+
+class Progress(object):
+    """Logs the rate at which items pass through a stream."""
+
+    def __init__(self, label, path=None, period=5.0):
+        self.label = label
+        self.path = path
+        self.period = period
+        self.items = 0
+        self.start = time.time()
+        self._last = self.start
+
+    def update(self, chunk):
+        self.items += len(chunk)
+        now = time.time()
+        if now - self._last >= self.period:
+            self._last = now
+            self.report()
+
+    def report(self):
+        elapsed = max(time.time() - self.start, 1e-6)
+        message = '%s: %d contexts, %.0f contexts/s' % (
+            self.label, self.items, self.items / elapsed)
+        if self.path and os.path.exists(self.path):
+            size = os.path.getsize(self.path) / (1024.0 * 1024.0)
+            message += ', %.1f MB at %.2f MB/s' % (size, size / elapsed)
+        logging.info(BLUE + message)
+
+
+def tee(chunks, *observers):
+    """Passes chunks through, handing each one to every observer first."""
+    for chunk in chunks:
+        for observer in observers:
+            observer.update(chunk)
+        yield chunk
@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 import argparse
+import heapq
 # import httplib
 import logging
-import pickle
 import random
 import re
 import sys
@@ -11,12 +11,28 @@ import signal
 import time
 import os
 import shutil
+import socket
 
-from threading import Timer, RLock
+from collections import deque
+from threading import Event, Thread, Timer, RLock
 
+try:
+    # use cPickle when using python2 for better performance
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import ingestfilter
 import irc
+import layers
+import learnqueue
 import logger
 import markov
+import nickindex
+import partition
+import replication
+import replycache
+import sharedchain
 from colortext import *
 
 PARSER = argparse.ArgumentParser(description='A snarky IRC bot.')
@@ -29,7 +45,24 @@ PARSER.add_argument("--channels", help="The list of channels to join", default="
 PARSER.add_argument("--save_period", help="How often (in seconds) to save databases", default=300)
 PARSER.add_argument("--seendb", help="Path to seendb", default="./seendb.pkl")
 PARSER.add_argument("--markovdb", help="Path to markovdb", default="./charrakdb")
+PARSER.add_argument("--send_rate", type=float, help="How many lines per second to send once the burst is used up (0 disables pacing)", default=0.5)
+PARSER.add_argument("--send_burst", type=int, help="How many lines may be sent back to back", default=5)
+PARSER.add_argument("--reconnect_max", type=float, help="Longest wait (in seconds) between reconnection attempts", default=300)
+PARSER.add_argument("--dbformat", help="Format to save the markov db in", choices=["pickle", "chunked"], default="pickle")
 PARSER.add_argument("--ignore", help="The optional list of nicks to ignore", default="")
+PARSER.add_argument("--partitions", type=int, help="Spread the markov db over this many worker processes (0 or 1 keeps it in-process)", default=0)
+PARSER.add_argument("--layers", help="Learn into per-channel (or per-channel and per-speaker) layers over a shared base db", choices=["none", "channel", "speaker"], default="none")
+PARSER.add_argument("--layer_weight", type=float, help="How much layer counts outweigh base counts", default=4.0)
+PARSER.add_argument("--reply_cache", type=int, help="How many seeds to keep pre-generated replies for (0 disables)", default=256)
+PARSER.add_argument("--learn_queue", type=int, help="How many distinct lines may wait to be learned in the background (0 learns synchronously)", default=10000)
+PARSER.add_argument("--learn_policy", help="Which line to drop when the learning queue is full", choices=learnqueue.POLICIES, default="drop_oldest")
+PARSER.add_argument("--dedup_window", type=float, help="Don't learn lines repeated within this many seconds (0 disables)", default=600)
+PARSER.add_argument("--speaker_rate", type=int, help="Don't learn more than this many lines per minute from one speaker (0 disables)", default=10)
+PARSER.add_argument("--reload_buffer", type=int, help="How many learned lines to buffer for replay while reloading the markov db", default=50000)
+PARSER.add_argument("--shared_chain", help="Generate from a chain published by publish_chain.py at this path (e.g. /dev/shm/charrak.chain) instead of loading the markov db; implies --readonly", default=None)
+PARSER.add_argument("--replicate_to", help="Stream the markov and seen dbs and everything learned to a standby listening on this Unix socket", default=None)
+PARSER.add_argument("--standby", help="Run as a warm standby, keeping a copy of the primary's dbs received on this Unix socket, and take over when it has been gone for --failover seconds or on SIGUSR1", default=None)
+PARSER.add_argument("--failover", type=float, help="How long (in seconds) a standby waits for a lost primary before taking over", default=30)
 PARSER.add_argument("--readonly", help="The bot will not learn from other users, only reply to them", dest='readonly', action='store_true')
 PARSER.set_defaults(readonly=False)
 
@@ -46,10 +79,24 @@ class Bot(object):
         self.IGNORE = [string.strip(ignore) for ignore in args.ignore.split(",")]
         self.CHANNELINIT = [string.strip(channel) for channel in args.channels.split(",")]
         self.IDENT='pybot'
-        self.READONLY = args.readonly
+        self.SEND_RATE = args.send_rate
+        self.SEND_BURST = args.send_burst
+
+        # Reconnection backoff: the delay doubles while connections keep
+        # failing, and resets once one has stayed up for a while.
+        self.RECONNECT_MIN = 1.0
+        self.RECONNECT_MAX = args.reconnect_max
+        self.RECONNECT_RESET = 60.0
+        self.reconnect_delay = self.RECONNECT_MIN
+        self.connected_at = 0
+        # A shared chain is mapped read-only, so it can't learn.
+        self.SHARED_CHAIN = args.shared_chain
+        self.READONLY = args.readonly or bool(self.SHARED_CHAIN)
 
         # Caches of IRC status
         self.seen = {} # lists of who said what when
+        self.seen_index = nickindex.NickIndex() # sorted keys of self.seen
+        self.MAX_SEEN_MATCHES = 5
 
         # Markov chain settings
         self.p_reply = 0.1
@@ -61,17 +108,69 @@ class Bot(object):
         # Set up a lock for the seen db
         self.seendb_lock = RLock()
         self.SEENDB = args.seendb
+        # Where the seen db is saved; moved aside if loading it failed.
+        self.seendb_path = self.SEENDB
 
         self.MARKOVDB = args.markovdb
+        self.DBFORMAT = args.dbformat
+        self.PARTITIONS = args.partitions
+        self.partitioned = None # started by main() before any other thread
+        self.LAYERS = args.layers
+        self.LAYER_WEIGHT = args.layer_weight
+        self.layers = None
+        self.REPLY_CACHE = args.reply_cache
+        self.reply_cache = None
+        self.LEARN_QUEUE = args.learn_queue
+        self.LEARN_POLICY = args.learn_policy
+        self.learn_queue = None
+        # Lines heard while the databases load wait in the queue, which
+        # only starts applying them once the chain is ready.
+        if self.LEARN_QUEUE > 0 and not self.READONLY:
+            self.learn_queue = learnqueue.LearningQueue(
+                self.learn, maxsize=self.LEARN_QUEUE,
+                policy=self.LEARN_POLICY)
+
+        # Databases load in the background; set once they are usable.
+        self.mc = None
+        self.ready = Event()
+        self.load_start = None
+        self.load_errors = [] # what failed to load, for get ready
+
+        # Hot reloading: lines learned while a new db loads are kept in
+        # replay and learned again by the new chain before the swap.  The
+        # chain swapped out is kept for rollback until the next reload.
+        self.RELOAD_BUFFER = args.reload_buffer
+        self.reload_lock = RLock()
+        self.reload_thread = None
+        self.replay = None
+        self.replay_dropped = 0
+        self.previous_mc = None
+
+        # Replication to (or from) a warm standby process
+        self.REPLICATE_TO = args.replicate_to
+        self.STANDBY = args.standby
+        self.FAILOVER = args.failover
+        self.replica = None
+        self.standby = None
+        self.promote = Event()
+
+        # Spam and flood suppression before learning
+        self.ingest_filter = None
+        if args.dedup_window > 0 or args.speaker_rate > 0:
+            self.ingest_filter = ingestfilter.IngestFilter(
+                window=args.dedup_window if args.dedup_window > 0 else None,
+                rate=args.speaker_rate if args.speaker_rate > 0 else None)
 
         # signal handling
         signal.signal(signal.SIGINT, self.signalHandler)
         signal.signal(signal.SIGTERM, self.signalHandler)
         signal.signal(signal.SIGQUIT, self.signalHandler)
+        if self.STANDBY:
+            signal.signal(signal.SIGUSR1, self.promoteHandler)
 
         # command registration
         self._commands = {
-            '!seen': (self._cmd_seen, 'When I last saw someone.'),
+            '!seen': (self._cmd_seen, 'When I last saw someone (or nick*).'),
             '!op': (self._cmd_op, 'Give someone ops.'),
             '!owners': (self._cmd_owners, 'Tell you who my owners are.'),
             '!ignore': (self._cmd_ignore, 'Begin ignoring someone.'),
@@ -93,42 +192,213 @@ class Bot(object):
 
     # Join the IRC network
     def joinIRC(self):
+        if self.irc:
+            self.irc.close()
+            self.irc = None
         self.irc = irc.Irc(self.HOST, self.PORT, self.NICK, self.IDENT,
-                           self.REALNAME)
-
-        # Join the initial channels
-        for chan in self.CHANNELINIT:
-            self.irc.join(chan)
-            if not self.irc.isop(self.NICK, chan):
-                op_reqs = [
-                    'Op me!', 'Yo, ops?',
-                    'What does a kobold have to do to get ops around here?']
-                which = random.randint(0, len(op_reqs)-1)
-                self.irc.privmsg(chan, op_reqs[which])
-
-    def initMarkovChain(self):
-        # Open our Markov chain database
-        self.mc = markov.MarkovChain(self.MARKOVDB)
+                           self.REALNAME, self.SEND_RATE, self.SEND_BURST)
+        self.connected_at = time.time()
 
-    def loadSeenDB(self):
-        with self.seendb_lock:
+        # Join the initial channels all at once; their populations are
+        # handled by the main loop as the NAMES replies arrive.
+        self.irc.joinAll(self.CHANNELINIT)
+
+    def reconnect(self):
+        if time.time() - self.connected_at > self.RECONNECT_RESET:
+            self.reconnect_delay = self.RECONNECT_MIN
+
+        while True:
+            # Wait between half and all of the delay, so that a crowd of
+            # bots dropped together doesn't come back together.
+            wait = random.uniform(self.reconnect_delay / 2,
+                                  self.reconnect_delay)
+            self.reconnect_delay = min(self.reconnect_delay * 2,
+                                       self.RECONNECT_MAX)
+            logging.warning(WARNING + ("Trying to reconnect in %.1f seconds..." %
+                                       wait))
+            time.sleep(wait)
             try:
-                with open(self.SEENDB, 'rb') as seendb:
-                    self.seen = pickle.load(seendb)
-            except IOError:
+                self.joinIRC()
+                return
+            except (socket.error, irc.ConnectionClosedException) as e:
+                logging.warning(WARNING + ("Reconnect failed: %s" % str(e)))
+
+    def handleNames(self, words):
+        chan = self.irc.handleNames(words)
+        if chan in self.CHANNELINIT and not self.irc.isop(self.NICK, chan):
+            op_reqs = [
+                'Op me!', 'Yo, ops?',
+                'What does a kobold have to do to get ops around here?']
+            which = random.randint(0, len(op_reqs)-1)
+            self.irc.privmsg(chan, op_reqs[which])
+
+    def initMarkovChain(self, chain=None):
+        # Open our Markov chain database, unless a standby was kept warm
+        if chain is not None:
+            self.mc = chain
+        elif self.SHARED_CHAIN:
+            self.mc = sharedchain.SharedChain(self.SHARED_CHAIN)
+        elif self.partitioned is not None:
+            self.mc = self.partitioned
+        else:
+            self.mc = markov.MarkovChain(self.MARKOVDB, self.DBFORMAT)
+        if self.LAYERS != "none":
+            self.layers = layers.ChannelLayers(
+                self.mc, self.MARKOVDB, weight=self.LAYER_WEIGHT,
+                per_speaker=(self.LAYERS == "speaker"),
+                dbFormat=self.DBFORMAT)
+        # Cached replies come from the base chain alone, so they would
+        # bypass the layers.
+        elif self.REPLY_CACHE > 0:
+            self.reply_cache = replycache.ReplyCache(self.mc,
+                                                     max_seeds=self.REPLY_CACHE)
+            self.reply_cache.start()
+
+        if self.learn_queue is not None:
+            self.learn_queue.start()
+
+    def loadSeenDB(self):
+        # Load without the lock so sightings can still be recorded, then
+        # keep any recorded meanwhile since they are newer.
+        try:
+            with open(self.SEENDB, 'rb') as seendb:
+                seen = pickle.load(seendb)
+        except Exception as e:
+            if isinstance(e, IOError) and not os.path.exists(self.SEENDB):
                 logging.error(WARNING +
                               ("Unable to open seen db '%s' for reading" %
                                self.SEENDB))
+                return
+            # Truncated or empty files raise EOFError, UnpicklingError and
+            # the like; start with an empty seen db rather than never.
+            logging.exception(ERROR + ("Seen db '%s' corrupt or unreadable: "
+                                       "Using empty seen db" % self.SEENDB))
+            self.load_errors.append("seen db unreadable (%s)" %
+                                    (str(e) or type(e).__name__))
+            self.seendb_path = self.setAside(self.SEENDB)
+            return
+        with self.seendb_lock:
+            seen.update(self.seen)
+            self.seen = seen
+            self.seen_index = nickindex.NickIndex(seen.keys())
+
+    def loadDatabases(self):
+        logging.info(YELLOW + 'Loading databases in the background')
+        self.loadSeenDB()
+        try:
+            self.initMarkovChain()
+        except Exception as e:
+            # Carry on with an empty chain rather than stay loading forever,
+            # which would silently drop everything learned until restart.
+            logging.exception(ERROR + 'Loading the markov db failed: '
+                              'Using empty database')
+            self.load_errors.append("markov db failed to load (%s)" %
+                                    (str(e) or type(e).__name__))
+            if self.reply_cache is not None:
+                self.reply_cache.stop()
+                self.reply_cache = None
+            self.layers = None
+            self.initMarkovChain(markov.MarkovChain(
+                self.setAside(self.MARKOVDB), self.DBFORMAT, load=False))
+        else:
+            # MarkovChain itself falls back to empty on a corrupt file.
+            failed = getattr(self.mc, 'loadFailed', None)
+            if failed:
+                self.load_errors.append("markov db unreadable (%s)" % failed)
+                self.mc.dbFilePath = self.setAside(self.MARKOVDB)
+        self.ready.set()
+        logging.info(GREEN + ('Databases loaded in %.1f seconds' %
+                              (time.time() - self.load_start)))
+        self.startReplication()
+
+    def setAside(self, path):
+        # Whatever failed to load is left alone, and its backup too, so
+        # the last good copy survives; saves go next to it instead.
+        aside = path + '.new'
+        logging.error(ERROR + ("Not saving over '%s': saving to '%s'" %
+                               (path, aside)))
+        return aside
+
+    def startReplication(self):
+        if not self.REPLICATE_TO:
+            return
+        if self.PARTITIONS > 1 or self.layers or self.SHARED_CHAIN:
+            logging.error(ERROR + 'Replication needs a single in-process '
+                          'markov db; not replicating')
+            return
+        path = self.REPLICATE_TO
+        self.replica = replication.Primary(lambda: replication.connect(path),
+                                           self.replicationSnapshot)
+        self.replica.start()
+        logging.info(GREEN + ('Replicating to %s' % path))
+
+    def replicationSnapshot(self):
+        # Nothing may be learned or seen between reading the journal
+        # position and copying the databases.
+        with self.reload_lock:
+            with self.seendb_lock:
+                with self.mc.db_lock:
+                    seq = self.replica.position()
+                    # Only copy under the locks; pickling and compressing
+                    # take several times longer and would stall the read
+                    # loop (and its PONGs) on every sighting.
+                    items = [(key, map(list, successors))
+                             for key, successors in self.mc.db.iteritems()]
+                seen = dict(self.seen)
+        return seq, replication.packChunks(items), seen
+
+    def applySnapshot(self, chunks, seen):
+        self.mc.replaceDatabase(chunks)
+        with self.seendb_lock:
+            self.seen = seen
+            self.seen_index = nickindex.NickIndex(seen.keys())
+        logging.info(GREEN + ('Standby copy has %d contexts and %d nicks' %
+                              (self.mc.size(), len(seen))))
+
+    def runStandby(self):
+        # Keep a warm copy of the primary's databases until it goes away.
+        self.mc = markov.MarkovChain(self.MARKOVDB, self.DBFORMAT, load=False)
+        self.standby = replication.Standby(self.applySnapshot, self.learn,
+                                           self.recordSeen)
+        self.standby.start(replication.listen(self.STANDBY))
+        logging.info(YELLOW + ('Standing by on %s' % self.STANDBY))
+
+        while not self.promote.wait(1.0):
+            lost = self.standby.lost()
+            if lost is not None and lost >= self.FAILOVER:
+                logging.warning(WARNING + 'The primary has gone away')
+                break
+        self.standby.stop()
+
+        if self.standby.snapshots:
+            logging.info(GREEN + 'Taking over from the primary')
+            self.initMarkovChain(self.mc)
+            self.ready.set()
+            self.startReplication()
+        else:
+            # Never heard from the primary, so start from disk.
+            logging.warning(WARNING + 'Taking over without a copy')
+            self.loadDatabases()
+
+    def promoteHandler(self, unused_signal, unused_frame):
+        self.promote.set()
+
+    def readiness(self):
+        if self.ready.is_set():
+            if self.load_errors:
+                return "ready, but " + "; ".join(self.load_errors)
+            return "ready"
+        return "loading for %.1f seconds" % (time.time() - self.load_start)
 
     def saveSeenDB(self):
         with self.seendb_lock:
             try:
-                with open(self.SEENDB, 'wb') as seendb:
+                with open(self.seendb_path, 'wb') as seendb:
                     pickle.dump(self.seen, seendb)
             except IOError:
                 logging.error(ERROR +
                               ("Unable to open seed db '%s' for writing" %
-                               self.SEENDB))
+                               self.seendb_path))
 
     def signalHandler(self, unused_signal, unused_frame):
         self.quit()
@@ -136,7 +406,19 @@ class Bot(object):
     def quit(self):
         if self.save_timer:
             self.save_timer.cancel()
+        if not self.ready.is_set():
+            # Saving now would overwrite the databases with partial ones.
+            logging.warning(WARNING + 'Quitting before the databases loaded')
+            self.irc = None
+            sys.exit(0)
+        if self.reply_cache is not None:
+            self.reply_cache.stop()
+        if self.learn_queue is not None:
+            self.learn_queue.stop()
+        if self.replica:
+            self.replica.stop()
         self.saveDatabases()
+        self.mc.close()
         self.irc = None
         sys.exit(0)
 
@@ -147,15 +429,37 @@ class Bot(object):
             shutil.copyfile(source, dst)
 
     def saveDatabases(self):
+        if not self.ready.is_set():
+            logging.info('Skipping save: databases are still loading')
+            return
         logging.info('Saving databases')
-        self.createBackup(self.MARKOVDB)
+        if self.learn_queue is not None:
+            self.learn_queue.flush()
+            logging.info('Learning queue: ' + self.learn_queue.stats())
+        if self.ingest_filter is not None:
+            logging.info('Ingest filter: ' + self.ingest_filter.stats())
+
+        if self.layers:
+            # Only the layers learn; the base is left untouched.
+            for path in self.layers.paths():
+                self.createBackup(path)
+        elif self.PARTITIONS > 1:
+            for path in self.mc.shardPaths:
+                self.createBackup(path)
+        elif not self.SHARED_CHAIN:
+            self.createBackup(self.mc.dbFilePath)
 
         if self.READONLY:
             logging.info('Skipping markov db because we are read-only')
+        elif self.layers:
+            self.layers.saveDatabases()
         else:
             self.mc.saveDatabase()
 
-        self.createBackup(self.SEENDB)
+        if self.reply_cache is not None:
+            logging.info('Reply cache: ' + self.reply_cache.stats())
+
+        self.createBackup(self.seendb_path)
         self.saveSeenDB()
 
     def handleSaveDatabasesTimer(self):
@@ -206,8 +510,26 @@ class Bot(object):
         if len(words) != 2:
             return self._cmd_help(speaker, speaking_to, ['!help', 'seen'])
 
+        if not self.ready.is_set():
+            self.irc.privmsg(speaking_to, "Hang on, I'm still loading.")
+            return True
+
         nick = words[1]
         key = nick.lower()
+        # A nick that was seen is answered as is, even if it looks like a
+        # pattern.
+        if key not in self.seen and nickindex.isPattern(key):
+            with self.seendb_lock:
+                matches = [(match, self.seen[match])
+                           for match in self.seen_index.match(key)]
+            if len(matches) == 1:
+                key = matches[0][0]
+                nick = key
+            elif matches:
+                self.irc.privmsg(speaking_to,
+                                 self.seenMatches(nick, matches))
+                return True
+
         seen_msg = "I haven't seen " + nick + "."
         if self.seen.has_key(key):
             seen_msg = nick + ' was last seen in '
@@ -221,6 +543,20 @@ class Bot(object):
         self.irc.privmsg(speaking_to, seen_msg)
         return True
 
+    def seenMatches(self, pattern, matches):
+        more = len(matches) > self.MAX_SEEN_MATCHES
+        # The most recently seen, most recent first.
+        matches = heapq.nlargest(self.MAX_SEEN_MATCHES, matches,
+                                 key=lambda match: match[1][1])
+        now = time.time()
+        reply = pattern + ' matches '
+        reply += ', '.join('%s (%s in %s)' % (
+            match, self.elapsedTime(now - seen[1]), seen[0])
+                           for match, seen in matches)
+        if more:
+            reply += ' and more'
+        return reply
+
     def _cmd_op(self, speaker, speaking_to, words):
         if len(words) != 2:
             return self._cmd_help(speaker, speaking_to, ['!help', 'op'])
@@ -311,10 +647,16 @@ class Bot(object):
         return False
 
     @staticmethod
-    def logChannel(speaker, msg):
+    def logChannel(speaker, msg, channel=None):
         logging.debug(CYAN + speaker + PLAIN + " : " + BLUE + msg)
+        # Only things actually said somewhere go in the corpus.
+        if channel:
+            logger.logCorpus(channel, speaker, msg)
 
     def possiblyReply(self, msg):
+        if not self.ready.is_set():
+            return
+
         PUNCTUATION = ",./?><;:[]{}\'\"!@#$%^&*()_-+="
         words = string.strip(msg["text"], PUNCTUATION).split()
 
@@ -335,8 +677,27 @@ class Bot(object):
         if not seed and (self.NICK.lower() not in [string.strip(word, PUNCTUATION).lower() for word in words]):
             return
 
+        chain = self.mc
+        if self.layers:
+            chain = self.layers.chainFor(msg["speaking_to"], msg["speaker"])
+
+        # The random bigram is a dead end, so pick the known context that
+        # best matches the message instead and lead with it.
+        include_seed = False
+        if not seed or not chain.hasContext(seed):
+            best = chain.findSeed(msg["text"])
+            if best:
+                logging.info(BLUE + "Using " + str(best) + " as seed")
+                seed = best
+                leading_words = ""
+                include_seed = True
+
         # generate a response
-        response = string.strip(self.mc.respond(seed))
+        if self.reply_cache is not None:
+            response = self.reply_cache.respond(seed, include_seed)
+        else:
+            response = chain.respond(seed, include_seed)
+        response = string.strip(response)
         if len(leading_words) > 0:
             leading_words = leading_words + " "
         reply = leading_words + response
@@ -345,7 +706,7 @@ class Bot(object):
             self.logChannel(self.NICK, "EMPTY_REPLY")
         else:
             self.irc.privmsg(msg["speaking_to"], reply)
-            self.logChannel(self.NICK, reply)
+            self.logChannel(self.NICK, reply, msg["speaking_to"])
 
     # @staticmethod
     # def makeTinyUrl(url):
@@ -370,7 +731,7 @@ class Bot(object):
             return
 
         # add the spoken phrase to the log
-        self.logChannel(msg["speaker"], msg["text"])
+        self.logChannel(msg["speaker"], msg["text"], msg["speaking_to"])
 
         # If a user has issued a command, don't do anything else.
         if self.handleCommands(msg):
@@ -380,8 +741,133 @@ class Bot(object):
 
         # add the phrase to the markov database if we're NOT in
         # readonly mode
-        if not self.READONLY:
-            self.mc.addLine(msg["text"])
+        if self.READONLY:
+            return
+        if self.ingest_filter is not None and not self.ingest_filter.allow(
+                msg["text"], msg["speaker"]):
+            return
+        entry = (msg["speaking_to"], msg["speaker"], msg["text"])
+        if self.learn_queue is not None:
+            self.learn_queue.put(entry)
+        elif self.ready.is_set():
+            self.learn([(entry, 1)])
+
+    # Apply a batch of ((channel, speaker, text), count) to the markov db.
+    def learn(self, batch):
+        if self.layers:
+            for (channel, speaker, text), count in batch:
+                for _ in range(count):
+                    self.layers.addLine(channel, speaker, text)
+            return
+
+        # Hold the reload lock so a swap can't land between buffering a
+        # line for replay and learning it.
+        with self.reload_lock:
+            if self.replay is not None:
+                for entry in batch:
+                    if len(self.replay) == self.replay.maxlen:
+                        self.replay_dropped += 1
+                    self.replay.append(entry)
+            self.mc.addLines(text for (_, _, text), count in batch
+                             for _ in range(count))
+            if self.replica:
+                self.replica.record('learn', batch)
+
+    def recordSeen(self, nick, entry):
+        # Lock here to avoid writing to the seen database while pickling it.
+        with self.seendb_lock:
+            if nick not in self.seen:
+                self.seen_index.add(nick)
+            self.seen[nick] = entry
+            if self.replica:
+                self.replica.record('seen', (nick, entry))
+
+    def replayInto(self, chain):
+        with self.reload_lock:
+            batch = list(self.replay)
+            self.replay.clear()
+        chain.addLines(text for (_, _, text), count in batch
+                       for _ in range(count))
+        return sum(count for _, count in batch)
+
+    def swapChain(self, chain):
+        with self.reload_lock:
+            self.previous_mc, self.mc = self.mc, chain
+            if self.layers:
+                self.layers.base = chain
+            if self.reply_cache is not None:
+                self.reply_cache.rebind(chain)
+            # The standby's copy is of the chain we just swapped out.
+            if self.replica:
+                self.replica.resync()
+
+    def reloadChain(self, path, owner):
+        start = time.time()
+        try:
+            chain = markov.MarkovChain(path, self.DBFORMAT)
+            # MarkovChain starts empty rather than failing, and an empty
+            # chain is never what was meant.
+            if not chain.size():
+                status = "Not reloading: '%s' is empty or unreadable" % path
+                with self.reload_lock:
+                    self.replay = None
+                return
+            # Saves keep going wherever they went before.
+            chain.dbFilePath = self.mc.dbFilePath
+
+            # Replay most of the buffer while learning carries on, then
+            # the remainder with learning held off while we swap.
+            replayed = self.replayInto(chain)
+            with self.reload_lock:
+                replayed += self.replayInto(chain)
+                self.replay = None
+                self.swapChain(chain)
+            status = ("Reloaded '%s' in %.1f seconds: %d contexts, "
+                      "%d lines replayed, %d dropped" %
+                      (path, time.time() - start, chain.size(), replayed,
+                       self.replay_dropped))
+        except Exception:
+            logging.exception(ERROR + 'Reloading the markov db failed')
+            status = "Reloading '%s' failed" % path
+            with self.reload_lock:
+                self.replay = None
+        finally:
+            logging.info(GREEN + status)
+            self.irc.privmsg(owner, status)
+
+    def startReload(self, path, owner):
+        if not self.ready.is_set():
+            return "Hang on, I'm still loading."
+        if self.PARTITIONS > 1:
+            return "Reloading isn't supported with partitions."
+        if self.SHARED_CHAIN:
+            return "Shared chains reload themselves when republished."
+        if self.reload_thread and self.reload_thread.is_alive():
+            return "Already reloading."
+        if not os.path.isfile(path):
+            return "No such database '%s'" % path
+
+        with self.reload_lock:
+            # Only one spare chain is kept, so drop the rollback copy
+            # before loading another.
+            if self.previous_mc:
+                self.previous_mc.close()
+                self.previous_mc = None
+            self.replay = deque(maxlen=self.RELOAD_BUFFER)
+            self.replay_dropped = 0
+        self.reload_thread = Thread(target=self.reloadChain,
+                                    args=(path, owner), name='reload')
+        self.reload_thread.daemon = True
+        self.reload_thread.start()
+        return "Reloading '%s'" % path
+
+    def rollback(self):
+        if self.reload_thread and self.reload_thread.is_alive():
+            return "Can't roll back while reloading."
+        if not self.previous_mc:
+            return "Nothing to roll back to."
+        self.swapChain(self.previous_mc)
+        return "Rolled back to the previous database"
 
     def parsePrivateOwnerMessage(self, msg):
         # The owner can issue commands to the bot, via strictly
@@ -416,6 +902,55 @@ class Bot(object):
                                 GREEN + "GET P_REPLY " + str(self.p_reply))
                 self.irc.privmsg(msg["speaker"], str(self.p_reply))
                 return
+            # ingest filter statistics
+            elif words[1] == "filter":
+                stats = "disabled"
+                if self.ingest_filter is not None:
+                    stats = self.ingest_filter.stats()
+                self.logChannel(msg["speaker"], GREEN + "GET FILTER " + stats)
+                self.irc.privmsg(msg["speaker"], stats)
+                return
+            # outgoing queue statistics
+            elif words[1] == "sendq":
+                stats = "disabled"
+                if self.irc.sendq:
+                    stats = self.irc.sendq.stats()
+                self.logChannel(msg["speaker"], GREEN + "GET SENDQ " + stats)
+                self.irc.privmsg(msg["speaker"], stats)
+                return
+            # database loading status
+            elif words[1] == "ready":
+                status = self.readiness()
+                self.logChannel(msg["speaker"], GREEN + "GET READY " + status)
+                self.irc.privmsg(msg["speaker"], status)
+                return
+            # learning queue statistics
+            elif words[1] == "queue":
+                stats = "disabled"
+                if self.learn_queue is not None:
+                    stats = self.learn_queue.stats()
+                self.logChannel(msg["speaker"], GREEN + "GET QUEUE " + stats)
+                self.irc.privmsg(msg["speaker"], stats)
+                return
+            # replication statistics
+            elif words[1] == "replication":
+                stats = "disabled"
+                if self.replica:
+                    stats = self.replica.stats()
+                elif self.standby:
+                    stats = self.standby.stats()
+                self.logChannel(msg["speaker"],
+                                GREEN + "GET REPLICATION " + stats)
+                self.irc.privmsg(msg["speaker"], stats)
+                return
+            # reply cache statistics
+            elif words[1] == "cache":
+                stats = "disabled"
+                if self.reply_cache is not None:
+                    stats = self.reply_cache.stats()
+                self.logChannel(msg["speaker"], GREEN + "GET CACHE " + stats)
+                self.irc.privmsg(msg["speaker"], stats)
+                return
 
         # leave a channel
         elif len(words) == 2 and (words[0] == 'leave' or words[0] == 'part'):
@@ -433,6 +968,22 @@ class Bot(object):
             self.irc.send('JOIN ' + channel + '\r\n')
             return
 
+        # swap in a retrained markov db without restarting
+        elif 1 <= len(words) <= 2 and words[0] == 'reload':
+            path = self.MARKOVDB
+            if len(words) == 2:
+                path = words[1]
+            self.logChannel(msg["speaker"], GREEN + "RELOAD " + path)
+            self.irc.privmsg(msg["speaker"], self.startReload(path,
+                                                              msg["speaker"]))
+            return
+
+        # go back to the db in use before the last reload
+        elif len(words) == 1 and words[0] == 'rollback':
+            self.logChannel(msg["speaker"], GREEN + "ROLLBACK")
+            self.irc.privmsg(msg["speaker"], self.rollback())
+            return
+
         # quit
         elif len(words) == 1 and (words[0] == 'quit' or words[0] == 'exit'):
             self.logChannel(msg["speaker"], RED + "QUIT")
@@ -500,11 +1051,9 @@ class Bot(object):
             return
 
         if msg["speaking_to"][0] == "#":
-            nick = msg["speaker"].lower()
-            # Lock here to avoid writing to the seen database while pickling it.
-            with self.seendb_lock:
-                self.seen[nick] = [msg["speaking_to"], time.time(),
-                                   string.strip(msg["text"])]
+            self.recordSeen(msg["speaker"].lower(),
+                            [msg["speaking_to"], time.time(),
+                             string.strip(msg["text"])])
 
         if msg["speaker"] in self.IGNORE:
             return
@@ -546,11 +1095,31 @@ class Bot(object):
             # strip the leading ':'
             self.irc.addwho(channel[1:], user)
 
+    def startPartitions(self):
+        # Shards are forked, so they must be started while the main thread
+        # is the only one; a lock (logging's, say) held by another thread
+        # at fork time would stay held forever in the child.  Each shard
+        # loads its own file, so this doesn't wait for the load.
+        if self.PARTITIONS > 1 and not self.SHARED_CHAIN:
+            self.partitioned = partition.PartitionedChain(
+                self.MARKOVDB, self.PARTITIONS, dbFormat=self.DBFORMAT)
+
     def main(self):
         logger.initialize("./")
-        self.initMarkovChain()
-        self.loadSeenDB()
-        self.joinIRC()
+        self.load_start = time.time()
+        self.startPartitions()
+        if self.STANDBY:
+            # Only connect once we have taken over.
+            self.runStandby()
+        else:
+            loader = Thread(target=self.loadDatabases, name='loader')
+            loader.daemon = True
+            loader.start()
+        try:
+            self.joinIRC()
+        except (socket.error, irc.ConnectionClosedException) as e:
+            logging.warning(WARNING + ("Connection failed: %s" % str(e)))
+            self.reconnect()
 
         self.save_timer = Timer(self.SAVE_TIME, self.handleSaveDatabasesTimer)
         self.save_timer.start()
@@ -559,10 +1128,9 @@ class Bot(object):
         while True:
             try:
                 recv = self.irc.readlines()
-            except irc.ConnectionClosedException:
-                logging.warning(WARNING + "Connection closed: Trying to reconnect in 5 seconds...")
-                time.sleep(5)
-                self.joinIRC()
+            except (socket.error, irc.ConnectionClosedException):
+                logging.warning(WARNING + "Connection closed")
+                self.reconnect()
                 continue
 
             for line in recv:
@@ -570,6 +1138,8 @@ class Bot(object):
                 # strip whitespace and split into words
                 words = string.rstrip(line)
                 words = string.split(words)
+                if len(words) < 2:
+                    continue
 
                 if words[0]=="PING":
                     self.irc.pong(words[1])
@@ -579,6 +1149,8 @@ class Bot(object):
                     self.parseModeMessage(words)
                 elif words[1] == 'PART' or words[1] == 'JOIN':
                     self.handlePartJoin(words)
+                elif words[1] == '353' or words[1] == '366':
+                    self.handleNames(words)
 
 #####
 
@@ -0,0 +1,190 @@
+"""Columnar holds markov databases as flat NumPy arrays.
+
+A Table keeps the vocabulary once and refers to words by id:
+  vocab      list of words
+  contexts   (n, 2) int32 word ids of each context, in order
+  context    int32 context id of each transition, sorted
+  successor  int32 word id each transition leads to
+  count      int64 count of each transition
+
+Tables are saved as .npz files, with the vocabulary as one byte buffer
+and its offsets so no pickling is needed.  Merging tables is a sort and a
+segmented sum over the concatenated columns, with no per-key Python work.
+
+NumPy is optional; without it np is None and nothing here works.
+"""
+
+import array
+import zipfile
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class Table(object):
+    def __init__(self, vocab, contexts, context, successor, count):
+        self.vocab = vocab
+        self.contexts = contexts
+        self.context = context
+        self.successor = successor
+        self.count = count
+
+    def size(self):
+        return len(self.contexts)
+
+    def transitions(self):
+        return len(self.count)
+
+
+def _intArray(values, dtype):
+    if not values:
+        return np.zeros(0, dtype=dtype)
+    return np.frombuffer(values, dtype='i%d' % values.itemsize).astype(dtype)
+
+
+def fromChunks(chunks):
+    """Builds a Table from chunks of (key, successors) items."""
+    ids = {}
+    vocab = []
+
+    def idOf(word):
+        wid = ids.get(word)
+        if wid is None:
+            wid = ids[word] = len(vocab)
+            vocab.append(word)
+        return wid
+
+    # Typed arrays take a fraction of the memory of lists while building.
+    contexts = array.array('i')
+    context = array.array('i')
+    successor = array.array('i')
+    count = array.array('l')
+    for chunk in chunks:
+        for key, successors in chunk:
+            cid = len(contexts) // 2
+            contexts.append(idOf(key[0]))
+            contexts.append(idOf(key[1]))
+            for weight, word in successors:
+                context.append(cid)
+                successor.append(idOf(word))
+                count.append(weight)
+
+    return Table(vocab, _intArray(contexts, np.int32).reshape(-1, 2),
+                 _intArray(context, np.int32),
+                 _intArray(successor, np.int32),
+                 _intArray(count, np.int64))
+
+
+def toChunks(table, chunk_size):
+    """Yields lists of (key, successors) items from a Table."""
+    vocab = table.vocab
+    # Transitions are sorted by context, so each context's are a slice.
+    starts = np.searchsorted(table.context,
+                             np.arange(table.size() + 1)).tolist()
+    for first in xrange(0, table.size(), chunk_size):
+        last = min(first + chunk_size, table.size())
+        contexts = table.contexts[first:last].tolist()
+        begin, end = starts[first], starts[last]
+        successor = table.successor[begin:end].tolist()
+        count = table.count[begin:end].tolist()
+
+        chunk = []
+        for ii, (first_word, second_word) in enumerate(contexts):
+            lo, hi = starts[first + ii] - begin, starts[first + ii + 1] - begin
+            chunk.append(((vocab[first_word], vocab[second_word]),
+                          [[count[jj], vocab[successor[jj]]]
+                           for jj in xrange(lo, hi)]))
+        yield chunk
+
+
+def save(dbfile, table, compress=True):
+    """Writes a Table to an open file as .npz."""
+    lengths = np.array([len(word) for word in table.vocab], dtype=np.int64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    data = np.frombuffer(''.join(table.vocab), dtype=np.uint8)
+    writer = np.savez_compressed if compress else np.savez
+    writer(dbfile, vocab_data=data, vocab_offsets=offsets,
+           contexts=table.contexts, context=table.context,
+           successor=table.successor, count=table.count)
+
+
+def load(path):
+    """Reads a Table from an .npz file, raising ValueError if it isn't one."""
+    if not zipfile.is_zipfile(path):
+        raise ValueError('"%s" is not a columnar database' % path)
+    try:
+        with np.load(path) as arrays:
+            data = arrays['vocab_data'].tostring()
+            offsets = arrays['vocab_offsets'].tolist()
+            return Table([data[offsets[ii]:offsets[ii + 1]]
+                          for ii in xrange(len(offsets) - 1)],
+                         arrays['contexts'], arrays['context'],
+                         arrays['successor'], arrays['count'])
+    except (KeyError, zipfile.BadZipfile) as e:
+        raise ValueError('"%s" is not a columnar database: %s' % (path, e))
+
+
+def merge(tables, weights=None):
+    """Returns the weighted sum of several Tables.
+
+    Each table's counts are scaled by its weight before they are added up;
+    the sums are rounded half up and transitions rounding to zero are
+    dropped.
+    """
+    if weights is None:
+        weights = [1.0] * len(tables)
+
+    # The vocabularies are small next to the transitions, so they are
+    # joined in Python and every table's ids remapped with one take().
+    ids = {}
+    vocab = []
+    firsts, seconds, nexts, counts = [], [], [], []
+    for table, weight in zip(tables, weights):
+        remap = np.empty(len(table.vocab), dtype=np.int32)
+        for ii, word in enumerate(table.vocab):
+            wid = ids.get(word)
+            if wid is None:
+                wid = ids[word] = len(vocab)
+                vocab.append(word)
+            remap[ii] = wid
+        keys = remap[table.contexts[table.context]]
+        firsts.append(keys[:, 0])
+        seconds.append(keys[:, 1])
+        nexts.append(remap[table.successor])
+        counts.append(table.count * float(weight))
+
+    if not sum(len(count) for count in counts):
+        return Table([], np.zeros((0, 2), dtype=np.int32),
+                     np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32),
+                     np.zeros(0, dtype=np.int64))
+
+    first = np.concatenate(firsts)
+    second = np.concatenate(seconds)
+    successor = np.concatenate(nexts)
+    count = np.concatenate(counts)
+
+    order = np.lexsort((successor, second, first))
+    first, second = first[order], second[order]
+    successor, count = successor[order], count[order]
+
+    # Sum the runs of identical transitions.
+    starts = np.ones(len(count), dtype=bool)
+    starts[1:] = ((first[1:] != first[:-1]) | (second[1:] != second[:-1]) |
+                  (successor[1:] != successor[:-1]))
+    starts = np.flatnonzero(starts)
+    # Round halves up, so a count of 1 weighted by 0.5 survives.
+    count = np.floor(np.add.reduceat(count, starts) + 0.5).astype(np.int64)
+    first, second, successor = first[starts], second[starts], successor[starts]
+
+    keep = count > 0
+    first, second = first[keep], second[keep]
+    successor, count = successor[keep], count[keep]
+
+    new_context = np.ones(len(count), dtype=bool)
+    new_context[1:] = (first[1:] != first[:-1]) | (second[1:] != second[:-1])
+    context = (np.cumsum(new_context) - 1).astype(np.int32)
+    contexts = np.column_stack((first[new_context], second[new_context]))
+    return Table(vocab, contexts.astype(np.int32), context, successor, count)
@@ -1,37 +1,80 @@
 #!/usr/bin/python
 import logging
-import markov
+import chainio
 import argparse
 import sys
 
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
+from colortext import *
 
 #
 
 ARGPARSER = argparse.ArgumentParser(description='Convert databases.')
 ARGPARSER.add_argument('--in', dest='db_in', default='./oldcharrakdb')
 ARGPARSER.add_argument('--out', dest='db_out', default='./newcharrakdb')
+ARGPARSER.add_argument('--from', dest='fmt_in', default='legacy',
+                       choices=chainio.FORMATS)
+ARGPARSER.add_argument('--to', dest='fmt_out', default='pickle',
+                       choices=chainio.FORMATS)
+ARGPARSER.add_argument('--codec', dest='codec', default='zlib',
+                       choices=sorted(chainio.CODECS))
+ARGPARSER.add_argument('--threads', dest='threads', type=int,
+                       default=chainio.THREADS)
+ARGPARSER.add_argument('--chunk_size', dest='chunk_size', type=int,
+                       default=chainio.CHUNK_SIZE)
+ARGPARSER.add_argument('--verify', dest='verify', default='checksum',
+                       choices=['none', 'checksum', 'sample'])
+ARGPARSER.add_argument('--sample_size', dest='sample_size', type=int,
+                       default=10000)
 ARGS = ARGPARSER.parse_args()
 
 #
 
+logging.getLogger().setLevel(logging.INFO)
+
 DB_IN = str(ARGS.db_in)
 DB_OUT = str(ARGS.db_out)
 
+if ARGS.verify == 'checksum':
+    EXPECTED = chainio.Checksum()
+elif ARGS.verify == 'sample':
+    EXPECTED = chainio.Sample(ARGS.sample_size)
+else:
+    EXPECTED = None
+
+PROGRESS = chainio.Progress('Converting', DB_OUT)
+OBSERVERS = [PROGRESS]
+if EXPECTED:
+    OBSERVERS.append(EXPECTED)
+
 try:
-    with open(DB_IN, 'rb') as dbfile:
-        DB = pickle.load(dbfile)
+    CHUNKS = chainio.readChunks(DB_IN, ARGS.fmt_in, ARGS.chunk_size,
+                                ARGS.threads)
+    chainio.writeChunks(DB_OUT, chainio.tee(CHUNKS, *OBSERVERS),
+                        ARGS.fmt_out, ARGS.codec, ARGS.threads)
 except IOError:
     logging.error('Unable to read database file "%s"', DB_IN)
     sys.exit(1)
 except ValueError:
     logging.error('Database "%s" corrupt or unreadable', DB_IN)
     sys.exit(2)
+PROGRESS.report()
 
-MC = markov.MarkovChain(DB_OUT)
-MC.db = DB[0]
-MC.saveDatabase()
-
+if ARGS.verify == 'checksum':
+    ACTUAL = chainio.Checksum()
+    for chunk in chainio.readChunks(DB_OUT, ARGS.fmt_out, ARGS.chunk_size,
+                                     ARGS.threads):
+        ACTUAL.update(chunk)
+    if ACTUAL != EXPECTED:
+        logging.error(ERROR + 'Checksum mismatch: wrote %s, read back %s',
+                      EXPECTED, ACTUAL)
+        sys.exit(3)
+    logging.info(GREEN + 'Verified %s', ACTUAL)
+elif ARGS.verify == 'sample':
+    BAD = EXPECTED.mismatches(
+        chainio.readChunks(DB_OUT, ARGS.fmt_out, ARGS.chunk_size,
+                           ARGS.threads))
+    if BAD:
+        logging.error(ERROR + '%d of %d sampled contexts differ', BAD,
+                      len(EXPECTED.items))
+        sys.exit(3)
+    logging.info(GREEN + 'Verified %d sampled contexts', len(EXPECTED.items))
@@ -0,0 +1,243 @@
+#!/usr/bin/python
+"""Evaluate_db scores a markov database against held-out lines.
+
+For every transition the held-out lines would teach, it checks whether the
+context and the transition are known and adds up the log-likelihood the
+chain gives it, with unknown transitions scored at --floor.  For a sample
+of lines it also draws a seed the way Bot.possiblyReply does and generates
+a reply, counting how often the seed is known, how often the fallback seed
+search is needed and how often the reply comes out empty.
+
+The database is loaded once and shared with a pool of worker processes by
+forking, and lines are handed out in chunks.
+"""
+import argparse
+import gzip
+import itertools
+import logging
+import math
+import multiprocessing
+import os
+import random
+import string
+import sys
+import time
+
+import chainio
+import logger
+import markov
+
+from colortext import *
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+#
+
+ARGPARSER = argparse.ArgumentParser(description='Evaluate a database.')
+ARGPARSER.add_argument('files', nargs='+',
+                       help='Held-out lines, one per line, plain or .gz. '
+                       'Files named *.jsonl* are read as corpus logs.')
+ARGPARSER.add_argument('--db', dest='db', default='./charrakdb')
+ARGPARSER.add_argument('--format', dest='fmt', default=None,
+                       choices=chainio.FORMATS,
+                       help='Database format (default: detect)')
+ARGPARSER.add_argument('--threads', dest='threads', type=int,
+                       default=chainio.THREADS)
+ARGPARSER.add_argument('--chunk_size', dest='chunk_size', type=int,
+                       default=chainio.CHUNK_SIZE)
+ARGPARSER.add_argument('--floor', dest='floor', type=float, default=1e-6,
+                       help='Probability given to unknown transitions')
+ARGPARSER.add_argument('--reply_rate', dest='reply_rate', type=float,
+                       default=0.1,
+                       help='Fraction of lines to generate a reply for')
+ARGPARSER.add_argument('--processes', dest='processes', type=int,
+                       default=multiprocessing.cpu_count())
+ARGPARSER.add_argument('--chunk_lines', dest='chunk_lines', type=int,
+                       default=10000)
+ARGPARSER.add_argument('--seed', dest='seed', type=int, default=0,
+                       help='Random seed, for repeatable reply sampling')
+ARGS = ARGPARSER.parse_args()
+
+#
+
+# As stripped by Bot.possiblyReply before it picks a seed.
+PUNCTUATION = ",./?><;:[]{}\'\"!@#$%^&*()_-+="
+
+STATS = ('lines', 'transitions', 'known_contexts', 'known_transitions',
+         'log_likelihood', 'replies', 'known_seeds', 'fallbacks', 'empty')
+
+CHAIN = None
+
+
+def drawSeed(text):
+    """Returns the seed Bot.possiblyReply would try for text, or None."""
+    words = string.strip(text, PUNCTUATION).split()
+    if len(words) < 2:
+        return None
+    max_index = min(6, len(words) - 1)
+    index = random.randint(1, max_index)
+    return (words[index - 1], words[index])
+
+
+def reply(text, stats):
+    seed = drawSeed(text)
+    if seed is None:
+        return
+    stats['replies'] += 1
+    include_seed = False
+    if CHAIN.hasContext(seed):
+        stats['known_seeds'] += 1
+    else:
+        best = CHAIN.findSeed(text)
+        if best:
+            stats['fallbacks'] += 1
+            seed = best
+            include_seed = True
+    if not string.strip(CHAIN.respond(seed, include_seed)):
+        stats['empty'] += 1
+
+
+def probabilities(lines, stats):
+    """Returns the chain's probability for each transition in lines.
+
+    Unknown transitions get 0.
+    """
+    db = CHAIN.db
+    result = []
+    for line in lines:
+        for bigram, word in markov.transitions(line):
+            successors = db.get(bigram)
+            if successors is None:
+                result.append(0.0)
+                continue
+            stats['known_contexts'] += 1
+            total = 0
+            count = 0
+            for value in successors:
+                total += value[0]
+                if value[1] == word:
+                    count = value[0]
+            if count:
+                stats['known_transitions'] += 1
+            result.append(float(count) / total)
+    return result
+
+
+def logLikelihood(probs, floor):
+    if np is not None:
+        return float(np.log(np.maximum(np.array(probs), floor)).sum())
+    return sum(math.log(max(p, floor)) for p in probs)
+
+
+def evaluate(job):
+    index, lines = job
+    # Seeded per chunk, so the sample doesn't depend on which worker
+    # gets which chunk.
+    random.seed((ARGS.seed, index))
+    stats = dict.fromkeys(STATS, 0)
+    stats['log_likelihood'] = 0.0
+    stats['lines'] = len(lines)
+    probs = probabilities(lines, stats)
+    stats['transitions'] = len(probs)
+    stats['log_likelihood'] = logLikelihood(probs, ARGS.floor)
+    for line in lines:
+        if random.random() < ARGS.reply_rate:
+            reply(line, stats)
+    return stats
+
+
+def openLines(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        if '.jsonl' in os.path.basename(path):
+            for _, _, _, text in logger.readCorpus(f):
+                yield text
+        else:
+            for line in f:
+                yield line.rstrip('\r\n')
+
+
+def chunks(paths, size):
+    chunk = []
+    for path in paths:
+        for line in openLines(path):
+            if not line or line.isspace():
+                continue
+            chunk.append(line)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def percent(part, whole):
+    return '%.2f%%' % (100.0 * part / whole if whole else 0.0)
+
+
+def report(totals, elapsed, out):
+    transitions = totals['transitions']
+    out.write('Lines:                 %d (%.0f/s)\n' % (
+        totals['lines'], totals['lines'] / max(elapsed, 1e-6)))
+    out.write('Transitions:           %d\n' % transitions)
+    out.write('Context coverage:      %s\n' % percent(
+        totals['known_contexts'], transitions))
+    out.write('Transition coverage:   %s\n' % percent(
+        totals['known_transitions'], transitions))
+    if transitions:
+        mean = totals['log_likelihood'] / transitions
+        out.write('Log-likelihood:        %.1f (%.3f per transition, '
+                  'floor %g)\n' % (totals['log_likelihood'], mean,
+                                   ARGS.floor))
+        out.write('Perplexity:            %.1f\n' % math.exp(-mean))
+    replies = totals['replies']
+    out.write('Replies simulated:     %d\n' % replies)
+    out.write('  seed known:          %s\n' % percent(totals['known_seeds'],
+                                                     replies))
+    out.write('  fallback seed:       %s\n' % percent(totals['fallbacks'],
+                                                     replies))
+    out.write('  EMPTY_REPLY:         %s\n' % percent(totals['empty'],
+                                                     replies))
+
+
+logging.getLogger().setLevel(logging.WARNING)
+
+START = time.time()
+CHAIN = markov.MarkovChain(str(ARGS.db), load=False)
+try:
+    CHAIN.replaceDatabase(chainio.readChunks(str(ARGS.db), ARGS.fmt,
+                                              ARGS.chunk_size,
+                                              ARGS.threads))
+except IOError:
+    logging.error('Unable to read database file "%s"', ARGS.db)
+    sys.exit(1)
+except ValueError:
+    logging.error('Database "%s" corrupt or unreadable', ARGS.db)
+    sys.exit(2)
+sys.stderr.write('Loaded %d contexts in %.1fs\n' % (CHAIN.size(),
+                                                     time.time() - START))
+
+# Workers are forked after loading, so they share the chain's pages.
+TOTALS = dict.fromkeys(STATS, 0)
+START = time.time()
+JOBS = enumerate(chunks(ARGS.files, ARGS.chunk_lines))
+if ARGS.processes > 1:
+    POOL = multiprocessing.Pool(ARGS.processes)
+    RESULTS = POOL.imap_unordered(evaluate, JOBS)
+else:
+    RESULTS = itertools.imap(evaluate, JOBS)
+try:
+    for stats in RESULTS:
+        for name in STATS:
+            TOTALS[name] += stats[name]
+except IOError as e:
+    logging.error('Unable to read held-out lines: %s', e)
+    sys.exit(1)
+if ARGS.processes > 1:
+    POOL.close()
+    POOL.join()
+
+report(TOTALS, time.time() - START, sys.stdout)
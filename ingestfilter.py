@@ -0,0 +1,122 @@
+"""Ingestfilter keeps repeated lines and floods out of the markov db."""
+
+import re
+import time
+
+from collections import deque
+
+
+NOISE = re.compile(u'[\\W\\d_]+', re.UNICODE)
+
+
+def normalize(text):
+    """Reduces text to the form used to spot near-duplicates.
+
+    Case, digits, punctuation and spacing are ignored, so 'SPAM 1!' and
+    'spam 2' count as the same line.  Lines arrive as utf-8 bytes and are
+    compared as unicode, so letters in any script count.  A line that is
+    nothing but noise (emoticons, say) is compared as it is.
+    """
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    text = text.lower()
+    normalized = u' '.join(NOISE.sub(u' ', text).split())
+    if not normalized:
+        normalized = u' '.join(text.split())
+    return normalized.encode('utf-8')
+
+
+class IngestFilter(object):
+    """Decides which lines are worth learning from.
+
+    A line is skipped if a near-duplicate was seen recently, or if its
+    speaker has already had rate lines accepted in the last rate_period
+    seconds.  Recent lines are remembered as hashes in two generations of
+    at most max_lines each, covering the last window to 2 * window seconds,
+    so memory stays bounded.  With
+    window=None generations only rotate when full, and with rate=None
+    speakers are not limited.
+    """
+
+    def __init__(self, window=600.0, max_lines=50000, rate=10,
+                 rate_period=60.0):
+        self.window = window
+        self.max_lines = max_lines
+        self.rate = rate
+        self.rate_period = rate_period
+
+        self._current = set()
+        self._previous = set()
+        self._generation_start = None
+        self._speakers = {} # speaker -> deque of accepted line times
+
+        # Statistics
+        self.accepted = 0
+        self.duplicates = 0
+        self.rate_limited = 0
+        self.words_skipped = 0
+
+    def _rotate(self, now):
+        if self._generation_start is None:
+            self._generation_start = now
+        expired = (self.window is not None and
+                   now - self._generation_start >= self.window)
+        if expired or len(self._current) >= self.max_lines:
+            self._previous = self._current
+            self._current = set()
+            self._generation_start = now
+
+    def _isDuplicate(self, text, now):
+        self._rotate(now)
+        key = hash(normalize(text))
+        if key in self._current or key in self._previous:
+            return True
+        self._current.add(key)
+        return False
+
+    def _isFlooding(self, speaker, now):
+        if self.rate is None or speaker is None:
+            return False
+        times = self._speakers.get(speaker)
+        return (times is not None and len(times) == self.rate and
+                now - times[0] < self.rate_period)
+
+    def _recordAccepted(self, speaker, now):
+        # Only accepted lines count towards the rate, so repeating a line
+        # doesn't use up the speaker's budget.
+        if self.rate is None or speaker is None:
+            return
+        times = self._speakers.get(speaker)
+        if times is None:
+            if len(self._speakers) >= self.max_lines:
+                self._forgetQuietSpeakers(now)
+            times = deque(maxlen=self.rate)
+            self._speakers[speaker] = times
+        times.append(now)
+
+    def _forgetQuietSpeakers(self, now):
+        for speaker in self._speakers.keys():
+            if now - self._speakers[speaker][-1] >= self.rate_period:
+                del self._speakers[speaker]
+
+    def allow(self, text, speaker=None, now=None):
+        if now is None:
+            now = time.time()
+        if self._isFlooding(speaker, now):
+            self.rate_limited += 1
+        elif self._isDuplicate(text, now):
+            self.duplicates += 1
+        else:
+            self._recordAccepted(speaker, now)
+            self.accepted += 1
+            return True
+        self.words_skipped += len(text.split())
+        return False
+
+    def stats(self):
+        total = self.accepted + self.duplicates + self.rate_limited
+        skipped = 100.0 * (total - self.accepted) / total if total else 0.0
+        return ('accepted=%d duplicates=%d rate_limited=%d skipped=%.1f%% '
+                'words_skipped=%d' % (self.accepted, self.duplicates,
+                                      self.rate_limited, skipped,
+                                      self.words_skipped))
@@ -2,101 +2,275 @@ import errno
 import logging
 import socket
 import string
+import time
+
+from collections import deque, OrderedDict
+from threading import Condition, Thread
 
 from colortext import *
 
+# Most servers accept this many mode changes in one MODE line.
+MAX_MODES = 3
+
+# How long to wait for the server to welcome us before giving up.
+REGISTER_TIMEOUT = 60.0
+
 class ConnectionClosedException(Exception):
     def __init__(self, *args, **kwargs):
         Exception.__init__(self, *args, **kwargs)
 
 
+class SendScheduler(object):
+    """Paces outgoing lines so the server doesn't kill us for flooding.
+
+    Lines are released by a token bucket refilled at rate lines per second,
+    holding at most burst tokens.  Protocol lines (PONG, JOIN, ...) jump
+    the queue and are sent even when the bucket is empty.  Chatter is
+    queued per target and the targets are served round-robin, so one busy
+    channel can't starve the others.  Consecutive MODE changes queued for
+    the same channel are merged into one line of up to MAX_MODES changes.
+    """
+
+    def __init__(self, write, rate=0.5, burst=5):
+        self.write = write
+        self.rate = rate
+        self.burst = burst
+
+        self._tokens = float(burst)
+        self._refilled = time.time()
+        self._priority = deque() # [queued time, line, None]
+        self._targets = OrderedDict() # target -> deque of [time, line, modes]
+        self._depth = 0
+        self._cond = Condition()
+        self._stopped = False
+
+        # Statistics
+        self.sent = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+        self._thread = Thread(target=self._run, name='sendq')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def _queued(self):
+        self._depth += 1
+        self.max_depth = max(self.max_depth, self._depth)
+        self._cond.notify()
+
+    def putPriority(self, line):
+        with self._cond:
+            self._priority.append([time.time(), line, None])
+            self._queued()
+
+    def put(self, target, line):
+        with self._cond:
+            self._targets.setdefault(target, deque()).append(
+                [time.time(), line, None])
+            self._queued()
+
+    def putMode(self, channel, flag, arg):
+        with self._cond:
+            queue = self._targets.setdefault(channel, deque())
+            if queue:
+                last = queue[-1]
+                modes = last[2]
+                if modes and len(modes) < MAX_MODES and \
+                        modes[0][0][0] == flag[0]:
+                    modes.append((flag, arg))
+                    self.coalesced += 1
+                    return
+            queue.append([time.time(), None, [(flag, arg)]])
+            self._queued()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def _next(self):
+        # Called with the lock held; returns the next item to send or None.
+        if self._priority:
+            return self._priority.popleft(), None
+        if self._tokens < 1 or not self._targets:
+            return None, None
+        target, queue = next(self._targets.iteritems())
+        item = queue.popleft()
+        del self._targets[target]
+        if queue:
+            # Go to the back of the line.
+            self._targets[target] = queue
+        return item, target
+
+    @staticmethod
+    def _render(item, target):
+        if item[2] is None:
+            return item[1]
+        modes = item[2]
+        return 'MODE %s %s%s %s\r\n' % (
+            target, modes[0][0][0], ''.join(flag[1:] for flag, _ in modes),
+            ' '.join(arg for _, arg in modes))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        return
+                    self._refill(time.time())
+                    item, target = self._next()
+                    if item:
+                        break
+                    if self._depth:
+                        # Wait for the next token.
+                        self._cond.wait((1 - self._tokens) / self.rate)
+                    else:
+                        self._cond.wait()
+                self._tokens -= 1
+                self._depth -= 1
+                latency = time.time() - item[0]
+                self.sent += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+            try:
+                self.write(self._render(item, target))
+            except socket.error as e:
+                logging.error(RED + 'socket error while sending: ' + str(e))
+
+    def stats(self):
+        with self._cond:
+            average = self.total_latency / self.sent if self.sent else 0.0
+            return ('depth=%d max_depth=%d sent=%d coalesced=%d '
+                    'avg_latency=%.2fs max_latency=%.2fs' % (
+                        self._depth, self.max_depth, self.sent,
+                        self.coalesced, average, self.max_latency))
+
+
 class Irc(object):
-    def __init__(self, host, port, nick, ident, realname):
+    def __init__(self, host, port, nick, ident, realname, send_rate=0.5,
+                 send_burst=5):
         self.readbuffer = '' # store all the messages from server
+        self._backlog = [] # lines read during registration, not yet handled
 
         self._who = {} # lists of who is in what channels
         self._ops = {} # lists of ops is in what channels
+        self._names = {} # channel -> (population, operators) being listed
 
         self.irc = socket.socket()
-        self.irc.connect((host, port))
-        self.send("NICK %s\r\n" % nick)
-        self.send("USER %s %s bla :%s\r\n" % (ident, host, realname))
-
-        # This is a hack, but how should I detect when I've successfully joined
-        # a channel?
-        self._eatLinesUntilText('End of /MOTD command')
+        self.sendq = None
+        try:
+            self.irc.connect((host, port))
+
+            # Outgoing lines are paced unless send_rate is 0.
+            if send_rate > 0:
+                self.sendq = SendScheduler(self._write, send_rate, send_burst)
+            self.send("NICK %s\r\n" % nick)
+            self.send("USER %s %s bla :%s\r\n" % (ident, host, realname))
+            self._register()
+        except Exception:
+            # The caller retries with a new Irc, so don't leave this one's
+            # socket and send thread behind.
+            self.close()
+            raise
 
     def __del__(self):
         if self.irc:
             self.irc.close()
 
-    def _eatLinesUntilText(self, stopText):
-        # Loop until we encounter the passed in 'stopText'
-        while 1:
-            temp = self.readlines()
-
-            for line in temp:
-                logging.info(YELLOW + line)
-                words = string.rstrip(line)
-                words = string.split(words)
-
-                # TODO: pull this out into a method to check for pings
-                if len(words) > 0 and (words[0] == "PING"):
-                    self.pong(words[1])
-
-                # This is a hack, but how should I detect when to join
-                # a channel?
-                if line.find(stopText) != -1:
-                    return
+    def close(self):
+        if self.sendq:
+            self.sendq.stop()
+        if self.irc:
+            self.irc.close()
+            self.irc = None
 
-    def _eatLinesUntilEndOfNames(self):
-        # get the current population of the channel
-        # :magnet.llarian.net 353 gravy = #test333 :gravy @nrrd
-        # :magnet.llarian.net 366 gravy #test333 :
+    def _register(self):
+        # Registration is done once the server welcomes us (RPL_WELCOME).
+        # Whatever follows in the same read is kept for the main loop.
+        self.irc.settimeout(REGISTER_TIMEOUT)
+        try:
+            self._awaitWelcome()
+        finally:
+            self.irc.settimeout(None)
 
-        population = []
-        operators = []
+    def _awaitWelcome(self):
         while True:
             temp = self.readlines()
-            for line in temp:
+            for ii, line in enumerate(temp):
                 logging.info(YELLOW + line)
                 words = string.rstrip(line)
                 words = string.split(words)
+                if len(words) < 2:
+                    continue
 
-                if words[0] == 'PING':
+                if words[0] == "PING":
                     self.pong(words[1])
+                elif words[0] == "ERROR":
+                    raise ConnectionClosedException(line)
+                elif words[1] == '433':
+                    # ERR_NICKNAMEINUSE: most likely our previous connection
+                    # hasn't timed out yet, so back off and try again.
+                    raise ConnectionClosedException('Nick in use')
+                elif words[1] == '001':
+                    self._backlog = temp[ii+1:]
+                    return
 
-                elif words[1] == '366':
-                    logging.info(DBLUE + 'Done parsing population')
-                    return population, operators
-
-                elif words[1] == '353':
-                    logging.info(DBLUE + 'Population of %s: %s',
-                                 words[4], words[5:])
-                    # get the current population of the channel
-                    for nick in words[5:]:
-                        op = False
-                        if nick[0] == "@":
-                            op = True
-                            nick = nick[1:]
-                        elif nick[0] == ":":
-                            nick = nick[1:]
-
-                        population += [nick]
-                        if op:
-                            operators += [nick]
+    def handleNames(self, words):
+        """Processes a NAMES reply line as it arrives.
+
+        :magnet.llarian.net 353 gravy = #test333 :gravy @nrrd
+        :magnet.llarian.net 366 gravy #test333 :
+
+        Returns the channel once its listing is complete, otherwise None.
+        """
+        if words[1] == '353' and len(words) > 4:
+            channel = words[4]
+            logging.info(DBLUE + 'Population of %s: %s', channel, words[5:])
+            population, operators = self._names.setdefault(channel, ([], []))
+            for nick in words[5:]:
+                nick = nick.lstrip(':')
+                op = False
+                if nick[:1] == "@":
+                    op = True
+                    nick = nick[1:]
+                if not nick:
+                    continue
+
+                population.append(nick)
+                if op:
+                    operators.append(nick)
+
+        elif words[1] == '366' and len(words) > 3:
+            channel = words[3]
+            population, operators = self._names.pop(channel, ([], []))
+            logging.info(DGREEN + channel + ' who: ' + ','.join(population))
+            logging.info(GREEN + channel + ' ops: ' + ','.join(operators))
+            self._who[channel] = self._uniquify(population)
+            self._ops[channel] = self._uniquify(operators)
+            return channel
+
+        return None
 
     def join(self, channel):
-        channel = str(channel)
-        if channel[0] != '#':
-            channel = '#' + channel
-        self.send('JOIN ' + channel + '\n')
-
-        population, operators = self._eatLinesUntilEndOfNames()
-        logging.info(DGREEN + channel + ' who: ' + ','.join(population))
-        logging.info(GREEN + channel + ' ops: ' + ','.join(operators))
-        self._who[channel] = self._uniquify(population)
-        self._ops[channel] = self._uniquify(operators)
+        # The population arrives later, through handleNames.
+        self.joinAll([channel])
+
+    def joinAll(self, channels):
+        names = []
+        for channel in channels:
+            channel = str(channel)
+            if channel[0] != '#':
+                channel = '#' + channel
+            names.append(channel)
+        if names:
+            self.send('JOIN ' + ','.join(names) + '\r\n')
 
     def part(self, channel):
         channel = str(channel)
@@ -105,15 +279,20 @@ class Irc(object):
         self.send('PART ' + channel + '\r\n')
 
     def readlines(self):
+        if self._backlog:
+            temp = self._backlog
+            self._backlog = []
+            return temp
+
         try:
             recv = self.irc.recv(1024)
             if len(recv) == 0:
                 raise ConnectionClosedException()
 
             self.readbuffer = self.readbuffer + recv
-        except socket.error as (code, msg):
-            logging.error(RED + 'socket error: ' + msg)
-            if code != errno.EINTR:
+        except socket.error as e:
+            logging.error(RED + 'socket error: ' + str(e))
+            if e.errno != errno.EINTR:
                 raise
 
         temp = string.split(self.readbuffer, "\n")
@@ -128,7 +307,7 @@ class Irc(object):
 
     def isop(self, nick, channel=None):
         if channel:
-            return nick in self._ops[channel]
+            return nick in self._ops.get(channel, [])
         else:
             for channel in self._ops:
                 if nick in self._ops[channel]:
@@ -140,7 +319,7 @@ class Irc(object):
         if self.isop(nick, channel=chan):
             return
         logging.info(PURPLE + ('Adding %s as op of %s' % (nick, chan)))
-        self._ops[chan].append(nick)
+        self._ops.setdefault(chan, []).append(nick)
 
     def rmop(self, chan, nick):
         if not self.isop(nick, channel=chan):
@@ -150,7 +329,7 @@ class Irc(object):
 
     def iswho(self, nick, channel=None):
         if channel:
-            return nick in self._who[channel]
+            return nick in self._who.get(channel, [])
         else:
             for channel in self._who:
                 if nick in self._who[channel]:
@@ -162,7 +341,7 @@ class Irc(object):
         if self.iswho(nick, channel=chan):
             return
         logging.info(CYAN + ('Adding %s in %s' % (nick, chan)))
-        self._who[chan].append(nick)
+        self._who.setdefault(chan, []).append(nick)
 
     def rmwho(self, chan, nick):
         if not self.iswho(nick, channel=chan):
@@ -176,17 +355,31 @@ class Irc(object):
             for who in self._who[chan]:
                 if nick == who:
                     logging.info(PURPLE + ('Setting +o on %s' % nick))
-                    self.send('MODE ' + chan + ' +o ' + nick + '\r\n')
+                    if self.sendq:
+                        self.sendq.putMode(chan, '+o', nick)
+                    else:
+                        self.send('MODE ' + chan + ' +o ' + nick + '\r\n')
                     self.addop(chan, nick)
 
     # Irc communication functions
     def privmsg(self, speaking_to, text):
         logging.debug(PURPLE + speaking_to + PLAIN + " : " + BLUE + text)
-        self.send('PRIVMSG '+ speaking_to +' :' + text + '\r\n')
+        line = 'PRIVMSG '+ speaking_to +' :' + text + '\r\n'
+        if self.sendq:
+            self.sendq.put(speaking_to, line)
+        else:
+            self._write(line)
 
     def pong(self, server):
         #cprint(GREEN, "PONG " + server + "\n")
         self.send("PONG %s\r\n" % server)
 
+    # Protocol traffic, sent ahead of any queued chatter.
     def send(self, msg):
+        if self.sendq:
+            self.sendq.putPriority(msg)
+        else:
+            self._write(msg)
+
+    def _write(self, msg):
         self.irc.sendall(msg)
@@ -0,0 +1,142 @@
+"""Layers overlays small per-channel and per-speaker chains on a base chain.
+
+The base chain is shared and read-mostly; everything learned at runtime goes
+into delta layers, each a MarkovChain persisted in its own file next to the
+base database.  Replies sample from the weighted sum of the counts in the
+base and the layers for the conversation at hand.
+"""
+
+import os
+import random
+import re
+
+from threading import RLock
+
+import markov
+
+
+def _layerPath(basePath, name):
+    return basePath + '.' + re.sub('[^\\w#@.-]', '_', name)
+
+
+class LayeredChain(markov.BaseChain):
+    """A read-only view merging a base chain with weighted delta layers."""
+
+    def __init__(self, base, layers, weight):
+        self.base = base
+        self.layers = layers
+        self.weight = weight
+
+    def _chains(self):
+        yield self.base, 1.0
+        for layer in self.layers:
+            yield layer, self.weight
+
+    def walking(self):
+        return self.base.walking()
+
+    def hasContext(self, bigram):
+        return any(chain.hasContext(bigram) for chain, _ in self._chains())
+
+    def randomContext(self):
+        # Pick a chain in proportion to its size, then a context within it.
+        chains = [(chain, chain.size()) for chain, _ in self._chains()]
+        total = sum(size for _, size in chains)
+        if not total:
+            return None
+        which = random.randint(0, total - 1)
+        for chain, size in chains:
+            if which < size:
+                return chain.randomContext()
+            which -= size
+
+    def rankSeeds(self, words):
+        best_score, best = 0, []
+        for chain, _ in self._chains():
+            score, bigrams = chain.rankSeeds(words)
+            if score > best_score:
+                best_score, best = score, bigrams
+            elif score == best_score:
+                best.extend(bigrams)
+        return best_score, best
+
+    def sampleNext(self, bigram):
+        weights = {}
+        for chain, weight in self._chains():
+            for count, word in chain.successors(bigram) or []:
+                weights[word] = weights.get(word, 0.0) + weight * count
+        if not weights:
+            return None
+
+        which = random.random() * sum(weights.itervalues())
+        for word, weight in weights.iteritems():
+            which -= weight
+            if which < 0:
+                return word
+        return word
+
+
+class ChannelLayers(object):
+    """Owns the delta layers laid over a base chain.
+
+    Each channel gets a layer, and with per_speaker each speaker gets one
+    too.  weight is how much a count in a layer is worth relative to the
+    same count in the base.
+    """
+
+    def __init__(self, base, basePath, weight=4.0, per_speaker=False,
+                 dbFormat='pickle'):
+        self.base = base
+        self.basePath = basePath
+        self.dbFormat = dbFormat
+        self.weight = weight
+        self.per_speaker = per_speaker
+        self._layers = {}
+        self._lock = RLock()
+
+    def _layer(self, name, create=True):
+        with self._lock:
+            layer = self._layers.get(name)
+            if layer is None:
+                path = _layerPath(self.basePath, name)
+                # Replying to someone doesn't give them a layer; only
+                # learning or an earlier run's file does.
+                exists = os.path.exists(path)
+                if not create and not exists:
+                    return None
+                layer = markov.MarkovChain(path, self.dbFormat, load=exists)
+                self._layers[name] = layer
+            return layer
+
+    def _layerNames(self, channel, speaker):
+        names = []
+        if channel and channel[0] == '#':
+            names.append(channel.lower())
+        if self.per_speaker and speaker:
+            names.append('@' + speaker.lower())
+        return names
+
+    def chainFor(self, channel, speaker=None):
+        layers = [layer for layer in
+                  (self._layer(name, create=False)
+                   for name in self._layerNames(channel, speaker))
+                  if layer is not None]
+        if not layers:
+            return self.base
+        return LayeredChain(self.base, layers, self.weight)
+
+    def addLine(self, channel, speaker, line):
+        for name in self._layerNames(channel, speaker):
+            self._layer(name).addLine(line)
+
+    def _nonEmpty(self):
+        with self._lock:
+            return [layer for layer in self._layers.itervalues()
+                    if layer.size()]
+
+    def saveDatabases(self):
+        # Empty layers have nothing worth a file.
+        return all([layer.saveDatabase() for layer in self._nonEmpty()])
+
+    def paths(self):
+        return [layer.dbFilePath for layer in self._nonEmpty()]
@@ -0,0 +1,113 @@
+"""Learnqueue moves learning off the thread that reads from IRC."""
+
+import logging
+
+from collections import OrderedDict
+from threading import Condition, RLock, Thread
+
+from colortext import *
+
+POLICIES = ('drop_oldest', 'drop_newest')
+
+
+class LearningQueue(object):
+    """A bounded queue of lines, applied in batches by a background thread.
+
+    put() is O(1) and never blocks.  Identical pending entries are coalesced
+    into one entry with a count, and once maxsize distinct entries are
+    pending the policy decides whether the oldest or the newest is dropped.
+    apply is called with lists of (entry, count) pairs.
+    """
+
+    def __init__(self, apply, maxsize=10000, batch_size=256,
+                 policy='drop_oldest'):
+        if policy not in POLICIES:
+            raise ValueError('Unknown queue policy "%s"' % policy)
+        self.apply = apply
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.policy = policy
+
+        self._pending = OrderedDict() # entry -> count, oldest first
+        self._cond = Condition()
+        # Held while a batch is being applied, so flush() can wait for it.
+        self._apply_lock = RLock()
+        self._stopped = False
+        self._worker = None
+
+        # Statistics
+        self.queued = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.applied = 0
+
+    def start(self):
+        if self._worker is not None:
+            return
+        self._worker = Thread(target=self._run, name='learnqueue')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def put(self, entry):
+        with self._cond:
+            self.queued += 1
+            if entry in self._pending:
+                self._pending[entry] += 1
+                self.coalesced += 1
+                return
+            if len(self._pending) >= self.maxsize:
+                self.dropped += 1
+                if self.policy == 'drop_newest':
+                    return
+                _, count = self._pending.popitem(last=False)
+                self.dropped += count - 1
+            self._pending[entry] = 1
+            self._cond.notify()
+
+    def _take(self, limit):
+        batch = []
+        while self._pending and len(batch) < limit:
+            batch.append(self._pending.popitem(last=False))
+        return batch
+
+    def _apply(self, batch):
+        try:
+            self.apply(batch)
+        except Exception:
+            logging.exception(ERROR + 'Failed to learn %d lines' % len(batch))
+        self.applied += sum(count for _, count in batch)
+
+    def flush(self):
+        """Applies everything pending before returning."""
+        with self._apply_lock:
+            with self._cond:
+                batch = self._take(len(self._pending))
+            if batch:
+                self._apply(batch)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+            # Take the batch under the apply lock so that a flush can't
+            # finish while this batch is still outstanding.
+            with self._apply_lock:
+                with self._cond:
+                    batch = self._take(self.batch_size)
+                if batch:
+                    self._apply(batch)
+
+    def stats(self):
+        with self._cond:
+            return ('pending=%d queued=%d coalesced=%d dropped=%d '
+                    'applied=%d' % (len(self._pending), self.queued,
+                                    self.coalesced, self.dropped,
+                                    self.applied))
@@ -1,9 +1,14 @@
+import json
 import logging
 import logging.handlers
 import os
+import time
 
 from colortext import ENDC
 
+# Records of what was said, one JSON object per line, for training.
+CORPUS = logging.getLogger('corpus')
+
 def initialize(output_dir):
     """Initialize the logging module to log messages to the right places."""
     logger = logging.getLogger()
@@ -36,3 +41,40 @@ def initialize(output_dir):
     handler.setFormatter(formatter)
     logger.addHandler(handler)
 
+    # structured corpus of channel messages
+    handler = logging.handlers.RotatingFileHandler(
+        os.path.join(output_dir, "corpus.jsonl"), "a", encoding=None,
+        delay="true", maxBytes=16*1024*1024, backupCount=5)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    CORPUS.addHandler(handler)
+    CORPUS.setLevel(logging.INFO)
+    CORPUS.propagate = False
+
+
+def logCorpus(channel, speaker, text, when=None):
+    """Appends a message to the corpus log."""
+    if not CORPUS.handlers:
+        return
+    record = {
+        't': time.time() if when is None else when,
+        'c': channel.decode('utf-8', 'replace'),
+        's': speaker.decode('utf-8', 'replace'),
+        'x': text.decode('utf-8', 'replace'),
+    }
+    CORPUS.info(json.dumps(record, separators=(',', ':')))
+
+
+def readCorpus(lines):
+    """Yields (time, channel, speaker, text) from corpus log lines.
+
+    Strings come back as utf-8 encoded str, as they arrived from IRC.
+    Lines that aren't complete records are skipped.
+    """
+    loads = json.loads
+    for line in lines:
+        try:
+            record = loads(line)
+        except ValueError:
+            continue
+        yield (record['t'], record['c'].encode('utf-8'),
+               record['s'].encode('utf-8'), record['x'].encode('utf-8'))
@@ -1,92 +1,323 @@
 """Markov abstracts the markov chain and backing database."""
 
+import contextlib
 import logging
 import math
 import os
 import random
 import re
 
+from collections import Counter
 from threading import RLock
 
+import chainio
 from colortext import *
 
-try:
-    # use cPickle when using python2 for better performance
-    import cPickle as pickle
-except ImportError:
-    import pickle
 
+# How many words of a message, and how many contexts per word, are examined
+# when looking for a seed.  Together they bound the cost of findSeed.
+SEED_WORDS = 12
+SEED_SAMPLES = 8
 
-class MarkovChain(object):
-    def __init__(self, dbFilePath=None):
+# Score findSeed gives a bigram that appears verbatim in the message.
+VERBATIM_SCORE = 3
+
+# Longest reply respond will generate.
+MAX_REPLY_WORDS = 500
+
+# How many lines an IngestSession counts before merging them into the chain.
+INGEST_BATCH = 10000
+
+
+def parseLineIntoSentences(line):
+    line = re.sub('[\'/,@#<>!@#^&*]', '', line.lower())
+    return line.split('.!?()')
+
+
+def bigrams(sentence):
+    inp = sentence.split(' ')
+    output = []
+    for i in range(len(inp)-1):
+        output.append((inp[i], inp[i+1]))
+    return output
+
+
+def transitions(line):
+    """Returns the (bigram, next word) pairs addLine learns from line."""
+    output = []
+    for ss in parseLineIntoSentences(line):
+        bg = bigrams(ss)
+        for ii in range(0,len(bg)-1):
+            # if we're the last bigram, we map to EOL
+            new_value = ""
+            if ii == len(bg)-1:
+                new_value = "\n"
+            else:
+                new_value = bg[ii+1][1]
+            output.append((bg[ii], new_value))
+    return output
+
+
+def seedWords(text):
+    """Returns the normalized words of text that findSeed considers."""
+    return [w for w in parseLineIntoSentences(text)[0].split() if w][:SEED_WORDS]
+
+
+def pickWeighted(values):
+    """Picks a word from [[count, word], ...] in proportion to its count."""
+    # find sum of all response appearance counts
+    totalAppear = 0
+    for v in values:
+        totalAppear = totalAppear + v[0]
+
+    which = int(math.floor(random.random()*totalAppear) + 1)
+    ii = 0
+    for v in values:
+        ii = ii + v[0]
+        if ii >= which:
+            return v[1]
+    return None
+
+
+class IngestSession(object):
+    """Counts transitions locally and merges them into a chain in batches.
+
+    Use as a context manager, or call flush() when done:
+
+        with chain.ingestSession() as session:
+            for line in lines:
+                session.addLine(line)
+    """
+
+    def __init__(self, chain, batch_size=INGEST_BATCH):
+        self.chain = chain
+        self.batch_size = batch_size
+        self.lines = 0
+        self._counts = Counter()
+        self._pending = 0
+
+    def addLine(self, line):
+        self._counts.update(transitions(line))
+        self.lines += 1
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._counts:
+            self.chain.addCounts(self._counts.iteritems())
+            self._counts = Counter()
+        self._pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *unused_exc):
+        self.flush()
+
+
+class BaseChain(object):
+    """Reply generation and batched learning shared by every chain.
+
+    Subclasses provide sampleNext(bigram), randomContext() and
+    rankSeeds(words), which returns (score, [bigram, ...]), and chains that
+    learn provide addCounts(((bigram, word), count) pairs).  Chains where a
+    step is expensive can override sampleWords to take several at once.
+    """
+
+    def close(self):
+        pass
+
+    @contextlib.contextmanager
+    def walking(self):
+        """Held for the whole of a reply.
+
+        Chains whose contents can be replaced part way through a reply
+        override this to walk it all on one version.
+        """
+        yield
+
+    def addLines(self, lines):
+        """Learns from lines, merging their counts in a single update."""
+        with self.ingestSession(batch_size=float('inf')) as session:
+            for line in lines:
+                session.addLine(line)
+
+    def ingestSession(self, batch_size=INGEST_BATCH):
+        return IngestSession(self, batch_size)
+
+    def findSeed(self, text):
+        """Returns the known context sharing the most words with text.
+
+        Bigrams appearing verbatim in text win outright; otherwise a bounded
+        sample of the contexts indexed under each word is scored by overlap.
+        Returns None if no word of text is known.
+        """
+        _, best = self.rankSeeds(seedWords(text))
+        if not best:
+            return None
+        return random.choice(best)
+
+    def sampleWords(self, bigram, limit):
+        """Returns up to limit words following bigram, ending at a dead end."""
+        words = []
+        context = tuple(bigram)
+        while len(words) < limit:
+            word = self.sampleNext(context)
+            if word is None:
+                break
+            words.append(word)
+            context = (context[1], word)
+        return words
+
+    def respond(self, bigram, include_seed=False):
+        with self.walking():
+            return self._respond(bigram, include_seed)
+
+    def _respond(self, bigram, include_seed):
+        include_bigram = include_seed
+        # If no bigram given as a seed, pick a random one.
+        if not bigram:
+            bigram = self.randomContext()
+            if not bigram:
+                logging.warn(WARNING + "No seed available: database is empty")
+                return ""
+            include_bigram = True
+            logging.info(BLUE + "Picking " + str(bigram) + " as seed")
+
+        # Must be a bigram
+        if len(bigram) != 2:
+            logging.error(ERROR +
+                          ("Invalid bigram %s passed as seed" % str(bigram)))
+            return ""
+
+        response = " ".join(self.sampleWords(bigram, MAX_REPLY_WORDS))
+        if include_bigram:
+            response = bigram[0] + " " + bigram[1] + " " + response
+        return response
+
+
+class MarkovChain(BaseChain):
+    def __init__(self, dbFilePath=None, dbFormat='pickle', load=True):
         #self.db = {("","") : []}
         self.db = {}
         self.db_lock = RLock()
 
+        # Every key of self.db, so random seeds can be picked in O(1).
+        self.contexts = []
+        # Inverted index of word -> contexts containing that word.
+        self.word_index = {}
+        # Callables notified with the contexts each addLine changed.
+        self.listeners = []
+
         self.dbFilePath = dbFilePath
         if not dbFilePath:
             self.dbFilePath = os.path.join(os.path.dirname(__file__),
                                            "markovdb")
+        # The format saveDatabase writes; loading detects it.
+        self.dbFormat = dbFormat
+        # Why an existing database couldn't be loaded, if it couldn't.
+        self.loadFailed = None
 
+        if not load:
+            return
         with self.db_lock:
             try:
-                with open(self.dbFilePath, 'rb') as dbfile:
-                    self.db = pickle.load(dbfile)
-            except IOError:
+                self.db = chainio.load(self.dbFilePath)
+            except IOError as e:
+                if os.path.exists(self.dbFilePath):
+                    self.loadFailed = str(e)
                 logging.warn(WARNING +
                              ("Unable to read database file '%s': "
                               "Using empty database" % self.dbFilePath))
-            except ValueError:
+            except ValueError as e:
+                self.db = {}
+                self.loadFailed = str(e)
                 logging.warn(WARNING +
                              ("Database '%s' corrupt or unreadable: "
                               "Using empty database" % self.dbFilePath))
+            self._buildIndex()
+
+    def replaceDatabase(self, chunks):
+        """Replaces the whole database with chunks of (key, successors)."""
+        db = {}
+        for chunk in chunks:
+            db.update(chunk)
+        with self.db_lock:
+            self.db = db
+            self._buildIndex()
+
+    def _buildIndex(self):
+        with self.db_lock:
+            self.contexts = []
+            self.word_index = {}
+            for bigram in self.db:
+                self._indexContext(bigram)
+
+    def _indexContext(self, bigram):
+        self.contexts.append(bigram)
+        for word in set(bigram):
+            if word:
+                self.word_index.setdefault(word, []).append(bigram)
 
     def parseLineIntoSentences(self, line):
-        line = re.sub('[\'/,@#<>!@#^&*]', '', line.lower())
-        return line.split('.!?()')
+        return parseLineIntoSentences(line)
 
     def bigrams(self, sentence):
-        inp = sentence.split(' ')
-        output = []
-        for i in range(len(inp)-1):
-            output.append((inp[i], inp[i+1]))
-        return output
+        return bigrams(sentence)
+
+    def addListener(self, listener):
+        self.listeners.append(listener)
+
+    def removeListener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def _notify(self, contexts):
+        for listener in self.listeners:
+            listener(contexts)
+
+    def _addTransition(self, bigram, new_value, count=1):
+        # Callers must hold db_lock.
+        if self.db.get(bigram) == None:
+            # we've never seen this bigram
+            self.db[bigram] = [[count, new_value]]
+            self._indexContext(bigram)
+        else:
+            # seen it:
+            val = self.db[bigram]
+            for rr in val:
+                if rr[1] == new_value:
+                    rr[0] = rr[0] + count
+                    break
+            else:
+                val.append([count, new_value])
 
     def addLine(self, line):
-        sentences = self.parseLineIntoSentences(line)
-        for ss in sentences:
-            bg = self.bigrams(ss)
-            for ii in range(0,len(bg)-1):
-                # if we're the last bigram, we map to EOL
-                new_value = ""
-                if ii == len(bg)-1:
-                    new_value = "\n"
-                else:
-                    new_value = bg[ii+1][1]
-
-                with self.db_lock:
-                    if self.db.get(bg[ii]) == None:
-                        # we've never seen this bigram
-                        self.db[bg[ii]] = [[1, new_value]]
-                    else:
-                        # seen it:
-                        val = self.db[bg[ii]]
-                        found = False
-                        for rr in val:
-                            if rr[1] == new_value:
-                                rr[0] = rr[0] + 1
-                                found = True
-                                break
-                        if not found:
-                            val.append([1, bg[ii+1][1]])
-
-                        self.db[bg[ii]] = val
+        changed = []
+        for bigram, new_value in transitions(line):
+            with self.db_lock:
+                self._addTransition(bigram, new_value)
+            changed.append(bigram)
+
+        if changed and self.listeners:
+            self._notify(changed)
+
+    def addCounts(self, counts):
+        """Merges ((bigram, next word), count) pairs under a single lock."""
+        changed = []
+        with self.db_lock:
+            for (bigram, new_value), count in counts:
+                self._addTransition(bigram, new_value, count)
+                changed.append(bigram)
+
+        if changed and self.listeners:
+            self._notify(changed)
 
     def saveDatabase(self):
         with self.db_lock:
             try:
-                with open(self.dbFilePath, 'wb') as dbfile:
-                    pickle.dump(self.db, dbfile)
+                chainio.save(self.dbFilePath, self.db, self.dbFormat)
                 return True
             except IOError:
                 logging.error(ERROR +
@@ -94,59 +325,53 @@ class MarkovChain(object):
                                self.dbFilePath))
                 return False
 
-    def respond(self, bigram):
-        include_bigram = False
-        # If no bigram given as a seed, pick a random one.
-        if not bigram:
-            with self.db_lock:
-                bigram = random.choice(self.db.keys())
-                include_bigram = True
-                logging.info(BLUE + "Picking " + str(bigram) + " as seed")
+    def hasContext(self, bigram):
+        with self.db_lock:
+            return tuple(bigram) in self.db
 
-        # Must be a bigram
-        if len(bigram) != 2:
-            logging.error(ERROR +
-                          ("Invalid bigram %s passed as seed" % str(bigram)))
-            return ""
+    def size(self):
+        return len(self.contexts)
 
-        response = [""]
-        self._respondHelper(bigram, response)
-        if include_bigram:
-            response[0] = bigram[0] + " " + bigram[1] + " " + response[0]
-        return response[0]
+    def randomContext(self):
+        with self.db_lock:
+            if not self.contexts:
+                return None
+            return random.choice(self.contexts)
+
+    def rankSeeds(self, words):
+        """Returns (score, bigrams) for the best seeds for words."""
+        wordset = set(words)
+        with self.db_lock:
+            best = [bg for bg in bigrams(" ".join(words)) if bg in self.db]
+            if best:
+                return VERBATIM_SCORE, best
+
+            best_score = 0
+            for word in wordset:
+                contexts = self.word_index.get(word)
+                if not contexts:
+                    continue
+                for _ in range(min(SEED_SAMPLES, len(contexts))):
+                    bigram = random.choice(contexts)
+                    score = len(set(bigram) & wordset)
+                    if score > best_score:
+                        best, best_score = [bigram], score
+                    elif score == best_score:
+                        best.append(bigram)
+        return best_score, best
+
+    def successors(self, bigram):
+        """Returns a copy of the [[count, word], ...] list for bigram."""
+        with self.db_lock:
+            values = self.db.get(bigram)
+            if values == None:
+                return None
+            return [list(v) for v in values]
 
-    def _respondHelper(self, bigram, response):
-        # does it exist in our cache?
+    def sampleNext(self, bigram):
+        # pick a random response
         with self.db_lock:
-            if self.db.get(bigram) == None:
-                # end?
-                return
-                #  TODO: pick a random bigram?
-                # which = random.random() * len(self.cache)
-                # ii = 0
-                # for k, v in self.cache.iteritems():
-                #   if ii == which:
-                #     bg = k
-                #     break
-                #   ii = ii + 1
-
-            # pick a random response
-            values = self.db[bigram]
-            
-            # find sum of all response appearance counts
-            totalAppear = 0
-            for v in values:
-                totalAppear = totalAppear + v[0]
-
-            which = int(math.floor(random.random()*totalAppear) + 1)
-            ii = 0
-            for v in values:
-                ii = ii + v[0]
-                if ii >= which:
-                    if response[0] == "":
-                        response[0] = v[1]
-                    else:
-                        response[0] = response[0] + " " + v[1]
-                    newbigram = (bigram[1], v[1])
-                    self._respondHelper(newbigram, response)
-                    return
+            values = self.db.get(bigram)
+            if values == None:
+                return None
+            return pickWeighted(values)
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+import argparse
+import logging
+import sys
+import time
+
+import chainio
+import columnar
+
+from colortext import *
+
+#
+
+ARGPARSER = argparse.ArgumentParser(
+    description='Merge databases, optionally weighting each one.')
+ARGPARSER.add_argument('dbs', nargs='+',
+                       help='Databases to merge, each optionally followed by '
+                       ':weight, e.g. efnet.db:2 old.db:0.5')
+ARGPARSER.add_argument('--out', dest='db_out', default='./mergeddb')
+ARGPARSER.add_argument('--to', dest='fmt_out', default='npz',
+                       choices=chainio.FORMATS)
+ARGPARSER.add_argument('--codec', dest='codec', default='zlib',
+                       choices=sorted(chainio.CODECS))
+ARGPARSER.add_argument('--threads', dest='threads', type=int,
+                       default=chainio.THREADS)
+ARGPARSER.add_argument('--chunk_size', dest='chunk_size', type=int,
+                       default=chainio.CHUNK_SIZE)
+ARGS = ARGPARSER.parse_args()
+
+#
+
+logging.getLogger().setLevel(logging.INFO)
+
+if columnar.np is None:
+    logging.error(ERROR + 'Merging databases needs numpy')
+    sys.exit(1)
+
+
+def parseSpec(spec):
+    path, _, weight = spec.rpartition(':')
+    try:
+        return path, float(weight)
+    except ValueError:
+        # No weight, or a colon that is part of the path.
+        return spec, 1.0
+
+
+def loadTable(path):
+    fmt = chainio.detectFormat(path)
+    if fmt == 'npz':
+        return columnar.load(path)
+    return columnar.fromChunks(chainio.readChunks(path, fmt,
+                                                   ARGS.chunk_size,
+                                                   ARGS.threads))
+
+
+TABLES = []
+WEIGHTS = []
+for spec in ARGS.dbs:
+    path, weight = parseSpec(spec)
+    start = time.time()
+    try:
+        table = loadTable(path)
+    except IOError:
+        logging.error('Unable to read database file "%s"', path)
+        sys.exit(1)
+    except ValueError:
+        logging.error('Database "%s" corrupt or unreadable', path)
+        sys.exit(2)
+    logging.info(BLUE + 'Read %s: %d contexts, %d transitions in %.1fs, '
+                 'weight %g', path, table.size(), table.transitions(),
+                 time.time() - start, weight)
+    TABLES.append(table)
+    WEIGHTS.append(weight)
+
+START = time.time()
+MERGED = columnar.merge(TABLES, WEIGHTS)
+del TABLES
+logging.info(GREEN + 'Merged into %d contexts, %d transitions in %.1fs',
+             MERGED.size(), MERGED.transitions(), time.time() - START)
+
+DB_OUT = str(ARGS.db_out)
+START = time.time()
+if ARGS.fmt_out == 'npz':
+    with open(DB_OUT, 'wb') as dbfile:
+        columnar.save(dbfile, MERGED, ARGS.codec != 'none')
+else:
+    chainio.writeChunks(DB_OUT, columnar.toChunks(MERGED, ARGS.chunk_size),
+                        ARGS.fmt_out, ARGS.codec, ARGS.threads)
+logging.info(GREEN + 'Wrote %s in %.1fs', DB_OUT, time.time() - START)
@@ -0,0 +1,63 @@
+"""Nickindex finds seen nicks by prefix or glob pattern."""
+
+import bisect
+import fnmatch
+import re
+
+# Characters that make a !seen argument a pattern rather than a nick.
+# '[' and ']' are legal, and common, in nicks so they match literally.
+WILDCARDS = re.compile('[*?]')
+
+
+def isPattern(text):
+    return WILDCARDS.search(text) is not None
+
+
+class NickIndex(object):
+    """A sorted list of nicks, searched with bisect.
+
+    A pattern is narrowed to the nicks sharing its literal prefix (the text
+    before the first wildcard) with two binary searches, so patterns like
+    'nrrd*' cost O(log n) plus the matches examined.  Patterns starting
+    with a wildcard have no prefix and scan every nick.
+    """
+
+    def __init__(self, nicks=()):
+        self._nicks = sorted(set(nicks))
+
+    def add(self, nick):
+        where = bisect.bisect_left(self._nicks, nick)
+        if where == len(self._nicks) or self._nicks[where] != nick:
+            self._nicks.insert(where, nick)
+
+    def _range(self, prefix):
+        start = bisect.bisect_left(self._nicks, prefix)
+        if not prefix:
+            return start, len(self._nicks)
+        # Every string with the prefix sorts before prefix + the top char.
+        end = bisect.bisect_left(self._nicks, prefix + '\xff', start)
+        return start, end
+
+    def match(self, pattern, limit=None):
+        """Returns up to limit nicks matching pattern, in sorted order.
+
+        A pattern without wildcards matches as a prefix.
+        """
+        found = WILDCARDS.search(pattern)
+        if not found:
+            start, end = self._range(pattern)
+            if limit is not None:
+                end = min(end, start + limit)
+            return self._nicks[start:end]
+        start, end = self._range(pattern[:found.start()])
+        # fnmatch would read '[' as the start of a character class.
+        pattern = pattern.replace('[', '[[]')
+
+        matches = []
+        for ii in xrange(start, end):
+            nick = self._nicks[ii]
+            if fnmatch.fnmatchcase(nick, pattern):
+                matches.append(nick)
+                if limit is not None and len(matches) >= limit:
+                    break
+        return matches
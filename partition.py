@@ -0,0 +1,270 @@
+"""Partition shards a markov chain across local worker processes.
+
+Each worker owns the contexts that hash to it, persisted in its own
+'<db>.shardN' file.  The coordinator only buffers raw lines: every batch is
+sent to all the shards, and each tokenizes and counts it in parallel,
+keeping the transitions whose contexts it owns.  Replies are walked by
+whichever shard owns the current context, which keeps going until the
+context moves to another shard.
+"""
+
+import logging
+import multiprocessing
+import random
+import signal
+import zlib
+
+from collections import Counter
+from threading import RLock
+
+import markov
+from colortext import *
+
+
+def shardOf(bigram, shards):
+    return (zlib.crc32(bigram[0] + '\0' + bigram[1]) & 0xffffffff) % shards
+
+
+def _count(lines, index, shards):
+    """Counts the transitions in lines whose contexts shard index owns."""
+    counts = Counter()
+    for line in lines:
+        for transition in markov.transitions(line):
+            if shardOf(transition[0], shards) == index:
+                counts[transition] += 1
+    return counts
+
+
+def _walk(mc, bigram, limit, index, shards):
+    """Walks from bigram while its contexts stay in shard index.
+
+    Returns (words, more), where more is whether the walk left the shard
+    rather than reaching a dead end or limit.
+    """
+    words = []
+    context = bigram
+    while len(words) < limit:
+        word = mc.sampleNext(context)
+        if word is None:
+            return words, False
+        words.append(word)
+        context = (context[1], word)
+        if shardOf(context, shards) != index:
+            return words, len(words) < limit
+    return words, False
+
+
+def _serve(conn, dbFilePath, dbFormat, index, shards):
+    # The coordinator handles signals and tells us when to stop.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGQUIT, signal.SIG_DFL)
+
+    mc = markov.MarkovChain(dbFilePath, dbFormat)
+    while True:
+        try:
+            op, arg = conn.recv()
+        except EOFError:
+            return
+
+        if op == 'add':
+            mc.addCounts(arg)
+            continue
+        elif op == 'lines' or op == 'learn':
+            counts = _count(arg, index, shards)
+            mc.addCounts(counts.iteritems())
+            if op == 'lines':
+                continue
+            # Only 'learn' says which contexts changed.
+            result = list(set(bigram for bigram, _ in counts))
+        elif op == 'next':
+            result = mc.sampleNext(arg)
+        elif op == 'walk':
+            result = _walk(mc, arg[0], arg[1], index, shards)
+        elif op == 'successors':
+            result = mc.successors(arg)
+        elif op == 'has':
+            result = mc.hasContext(arg)
+        elif op == 'size':
+            result = mc.size()
+        elif op == 'random':
+            result = mc.randomContext()
+        elif op == 'seeds':
+            result = mc.rankSeeds(arg)
+        elif op == 'save':
+            result = mc.saveDatabase()
+        elif op == 'stop':
+            conn.send(True)
+            return
+        else:
+            result = None
+            logging.error(ERROR + ('Unknown shard request %s' % op))
+        conn.send(result)
+
+
+class _Shard(object):
+    def __init__(self, dbFilePath, dbFormat, index, shards):
+        self.dbFilePath = dbFilePath
+        self.conn, child = multiprocessing.Pipe()
+        self.lock = RLock()
+        self.process = multiprocessing.Process(target=_serve,
+                                               args=(child, dbFilePath,
+                                                     dbFormat, index, shards),
+                                               name='shard:' + dbFilePath)
+        self.process.daemon = True
+        self.process.start()
+
+    def post(self, op, arg=None):
+        with self.lock:
+            self.conn.send((op, arg))
+
+    def call(self, op, arg=None):
+        with self.lock:
+            self.conn.send((op, arg))
+            return self.conn.recv()
+
+
+class PartitionedChain(markov.BaseChain):
+    """A MarkovChain whose contexts are spread over worker processes.
+
+    Learning is batched: addLine only buffers lines until batch_size have
+    been seen, so a reply may not reflect the last few lines until flush()
+    or saveDatabase() is called.  With listeners, flush() waits for the
+    shards to report which contexts changed.
+    """
+
+    def __init__(self, dbFilePath, shards, batch_size=64, dbFormat='pickle'):
+        self.batch_size = batch_size
+        self.listeners = []
+        self._lock = RLock()
+        self._pending_lines = []
+
+        self.shards = [_Shard('%s.shard%d' % (dbFilePath, ii), dbFormat,
+                              ii, shards)
+                       for ii in range(shards)]
+        self.shardPaths = [shard.dbFilePath for shard in self.shards]
+        logging.info(GREEN + ('Started %d markov shards' % shards))
+
+    def _shardFor(self, bigram):
+        return self.shards[shardOf(bigram, len(self.shards))]
+
+    def _callAll(self, op, arg=None):
+        """Sends op to every shard before waiting for any of them."""
+        for shard in self.shards:
+            shard.lock.acquire()
+        try:
+            for shard in self.shards:
+                shard.conn.send((op, arg))
+            return [shard.conn.recv() for shard in self.shards]
+        finally:
+            for shard in self.shards:
+                shard.lock.release()
+
+    def addListener(self, listener):
+        self.listeners.append(listener)
+
+    def removeListener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def _notify(self, changed):
+        if changed:
+            for listener in self.listeners:
+                listener(changed)
+
+    def addLine(self, line):
+        with self._lock:
+            self._pending_lines.append(line)
+            if len(self._pending_lines) < self.batch_size:
+                return
+        self.flush()
+
+    def addLines(self, lines):
+        with self._lock:
+            self._pending_lines.extend(lines)
+        self.flush()
+
+    def addCounts(self, counts):
+        pending = [Counter() for _ in self.shards]
+        changed = []
+        for transition, count in counts:
+            bigram = transition[0]
+            pending[shardOf(bigram, len(self.shards))][transition] += count
+            changed.append(bigram)
+        with self._lock:
+            for shard, shard_counts in zip(self.shards, pending):
+                if shard_counts:
+                    shard.post('add', shard_counts.items())
+        self._notify(changed)
+
+    def flush(self):
+        changed = []
+        with self._lock:
+            lines, self._pending_lines = self._pending_lines, []
+            if not lines:
+                return
+            if not self.listeners:
+                for shard in self.shards:
+                    shard.post('lines', lines)
+                return
+            for contexts in self._callAll('learn', lines):
+                changed.extend(contexts)
+        self._notify(changed)
+
+    def saveDatabase(self):
+        self.flush()
+        return all(self._callAll('save'))
+
+    def close(self):
+        self.flush()
+        for shard in self.shards:
+            shard.call('stop')
+            shard.process.join()
+
+    def hasContext(self, bigram):
+        bigram = tuple(bigram)
+        return self._shardFor(bigram).call('has', bigram)
+
+    def size(self):
+        return sum(self._callAll('size'))
+
+    def randomContext(self):
+        # Weight shards by size so every context is equally likely.
+        sizes = self._callAll('size')
+        total = sum(sizes)
+        if not total:
+            return None
+        which = random.randint(0, total - 1)
+        for shard, size in zip(self.shards, sizes):
+            if which < size:
+                return shard.call('random')
+            which -= size
+
+    def rankSeeds(self, words):
+        best_score, best = 0, []
+        for score, bigrams in self._callAll('seeds', words):
+            if score > best_score:
+                best_score, best = score, bigrams
+            elif score == best_score:
+                best.extend(bigrams)
+        return best_score, best
+
+    def successors(self, bigram):
+        return self._shardFor(bigram).call('successors', bigram)
+
+    def sampleNext(self, bigram):
+        return self._shardFor(bigram).call('next', bigram)
+
+    def sampleWords(self, bigram, limit):
+        # One round trip per run of contexts in the same shard, rather
+        # than one per word.
+        words = []
+        context = tuple(bigram)
+        while len(words) < limit:
+            run, more = self._shardFor(context).call(
+                'walk', (context, limit - len(words)))
+            words.extend(run)
+            if not more:
+                break
+            context = (context + tuple(run))[-2:]
+        return words
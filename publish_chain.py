@@ -0,0 +1,73 @@
+#!/usr/bin/python
+import argparse
+import logging
+import os
+import sys
+import time
+
+import chainio
+import sharedchain
+
+from colortext import *
+
+#
+
+ARGPARSER = argparse.ArgumentParser(
+    description='Publish a database for bots started with --shared_chain.')
+ARGPARSER.add_argument('--db', dest='db', default='./charrakdb')
+ARGPARSER.add_argument('--format', dest='fmt', default=None,
+                       choices=chainio.FORMATS,
+                       help='Database format (default: detect)')
+ARGPARSER.add_argument('--path', dest='path',
+                       default=sharedchain.DEFAULT_PATH,
+                       help='Where to publish, ideally on a tmpfs')
+ARGPARSER.add_argument('--watch', dest='watch', type=float, default=0,
+                       help='Keep running, republishing whenever the '
+                       'database changes, checking this often (seconds)')
+ARGS = ARGPARSER.parse_args()
+
+#
+
+logging.getLogger().setLevel(logging.INFO)
+
+DB = str(ARGS.db)
+
+
+def publish():
+    start = time.time()
+    try:
+        db = chainio.load(DB, ARGS.fmt)
+    except IOError:
+        logging.error('Unable to read database file "%s"', DB)
+        return False
+    except ValueError:
+        logging.error('Database "%s" corrupt or unreadable', DB)
+        return False
+    contexts = sharedchain.publish(ARGS.path, db)
+    logging.info(GREEN + 'Published %d contexts from %s to %s in %.1fs',
+                 contexts, DB, ARGS.path, time.time() - start)
+    return True
+
+
+def modified():
+    try:
+        return os.path.getmtime(DB)
+    except OSError:
+        return None
+
+
+LAST = modified()
+if not publish() and not ARGS.watch:
+    sys.exit(1)
+
+while ARGS.watch:
+    time.sleep(ARGS.watch)
+    # Training scripts rewrite the db in place, so wait for it to settle.
+    CURRENT = modified()
+    if CURRENT is None or CURRENT == LAST:
+        continue
+    time.sleep(ARGS.watch)
+    if modified() != CURRENT:
+        continue
+    LAST = CURRENT
+    publish()
@@ -0,0 +1,404 @@
+"""Replication keeps a warm standby copy of a bot's databases.
+
+The primary sends a snapshot of its markov and seen databases, then a
+journal of every change made after it, as length-prefixed pickle frames
+over a local stream socket.  The standby applies each frame as it arrives
+and acknowledges it, so it holds an up-to-date copy in memory and can
+take over at once.  If the connection drops, the standby reconnects with
+the last sequence number it applied and the journal resumes from there,
+unless those entries have already been dropped, which costs a new
+snapshot.
+
+Frames from the primary:
+  ('chunk', data)                   a zlib compressed pickle of db items
+  ('snapshot', seq, epoch, seen)    the chunks so far are the db as of seq
+  ('learn', seq, batch)             ((channel, speaker, text), count) pairs
+  ('seen', seq, (nick, entry))      a seen db update
+Frames from the standby:
+  ('hello', epoch, seq)             what it already has, sent on connect
+  ('ack', seq)                      everything up to seq has been applied
+
+Frames are unpickled, so only listen on sockets that only trusted
+processes can reach, such as a Unix socket in a private directory.
+"""
+
+import itertools
+import logging
+import os
+import random
+import socket
+import struct
+import time
+import zlib
+
+from collections import deque
+from threading import Condition, Event, RLock, Thread
+
+import chainio
+from colortext import *
+
+try:
+    # use cPickle when using python2 for better performance
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+_LENGTH = struct.Struct('<I')
+
+
+def sendFrame(sock, message):
+    """Sends one message and returns the bytes written."""
+    data = pickle.dumps(message, 2)
+    sock.sendall(_LENGTH.pack(len(data)) + data)
+    return _LENGTH.size + len(data)
+
+
+def _recvExactly(sock, size):
+    parts = []
+    while size:
+        data = sock.recv(min(size, 1 << 20))
+        if not data:
+            if parts:
+                raise EOFError('Connection closed mid-frame')
+            return None
+        parts.append(data)
+        size -= len(data)
+    return ''.join(parts)
+
+
+def recvFrame(sock):
+    """Returns the next message, or None once the peer has closed."""
+    header = _recvExactly(sock, _LENGTH.size)
+    if header is None:
+        return None
+    data = _recvExactly(sock, _LENGTH.unpack(header)[0])
+    if data is None:
+        raise EOFError('Connection closed mid-frame')
+    return pickle.loads(data)
+
+
+def connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        raise
+    return sock
+
+
+def listen(path):
+    if os.path.exists(path):
+        os.remove(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(1)
+    return sock
+
+
+def packChunks(items, chunk_size=chainio.CHUNK_SIZE):
+    """Compresses db items into the chunks a snapshot is sent as.
+
+    Compressed chunks are a fraction of the size of the db, so a snapshot
+    can be held until it has been sent.
+    """
+    return [zlib.compress(pickle.dumps(chunk, 2), 1)
+            for chunk in chainio.chunked(items, chunk_size)]
+
+
+def unpackChunks(chunks):
+    for data in chunks:
+        yield pickle.loads(zlib.decompress(data))
+
+
+class Primary(object):
+    """Ships a snapshot and then a journal of changes to a standby.
+
+    connect() returns a socket connected to the standby.  snapshot()
+    returns (seq, packed chunks, seen) and must hold off record() while it
+    runs, so the copy is exactly the state after journal entry seq.  The
+    journal keeps at most max_backlog unacknowledged entries.
+    """
+
+    def __init__(self, connect, snapshot, max_backlog=100000, retry=5.0):
+        self.connect = connect
+        self.snapshot = snapshot
+        self.max_backlog = max_backlog
+        self.retry = retry
+
+        self._cond = Condition(RLock())
+        self._journal = deque() # (seq, time recorded, frame)
+        self._seq = 0
+        self._epoch = None
+        self._resync = True
+        self._stop = Event()
+        self._worker = None
+
+        # Statistics
+        self.connected = False
+        self.snapshots = 0
+        self.sent = 0
+        self.sent_bytes = 0
+        self.acked = 0
+        self.lag = 0.0
+        self.dropped = 0
+        self._start = time.time()
+
+    def position(self):
+        with self._cond:
+            return self._seq
+
+    def record(self, kind, payload):
+        with self._cond:
+            self._seq += 1
+            self._journal.append((self._seq, time.time(),
+                                  (kind, self._seq, payload)))
+            while len(self._journal) > self.max_backlog:
+                self._journal.popleft()
+                self.dropped += 1
+            self._cond.notify()
+
+    def resync(self):
+        """Sends a fresh snapshot, e.g. after the chain was replaced."""
+        with self._cond:
+            self._resync = True
+            self._cond.notify()
+
+    def start(self):
+        self._worker = Thread(target=self._run, name='replication')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def stop(self):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                sock = self.connect()
+            except socket.error:
+                self._stop.wait(self.retry)
+                continue
+            try:
+                self._serve(sock)
+            except (socket.error, EOFError) as e:
+                logging.warning(WARNING + ('Replication stopped: %s' % e))
+            except Exception:
+                logging.exception(ERROR + 'Replication failed')
+            finally:
+                self.connected = False
+                # Shut down as well, so the ack reader wakes up and the
+                # standby sees the connection close.
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+                sock.close()
+            self._stop.wait(self.retry)
+
+    def _sendSnapshot(self, sock):
+        seq, chunks, seen = self.snapshot()
+        with self._cond:
+            self._resync = False
+            self._epoch = '%016x' % random.getrandbits(64)
+            epoch = self._epoch
+            # The standby has everything up to seq in the snapshot.
+            while self._journal and self._journal[0][0] <= seq:
+                self._journal.popleft()
+        for data in chunks:
+            self.sent_bytes += sendFrame(sock, ('chunk', data))
+        self.sent_bytes += sendFrame(sock, ('snapshot', seq, epoch, seen))
+        self.snapshots += 1
+        logging.info(GREEN + ('Sent a replication snapshot at %d: %d chunks'
+                              % (seq, len(chunks))))
+        return seq
+
+    def _serve(self, sock):
+        hello = recvFrame(sock)
+        if not hello or hello[0] != 'hello':
+            raise EOFError('Standby did not say hello')
+        _, epoch, applied = hello
+        self.connected = True
+        reader = Thread(target=self._readAcks, args=(sock,),
+                        name='replication acks')
+        reader.daemon = True
+        reader.start()
+
+        with self._cond:
+            oldest = self._journal[0][0] if self._journal else self._seq + 1
+            resume = (not self._resync and epoch == self._epoch and
+                      oldest <= applied + 1)
+        if resume:
+            following = applied + 1
+            logging.info(GREEN + ('Resuming replication from %d' % following))
+        else:
+            following = self._sendSnapshot(sock) + 1
+
+        while not self._stop.is_set():
+            with self._cond:
+                while (not self._stop.is_set() and not self._resync and
+                       self._seq < following):
+                    self._cond.wait(1.0)
+                if self._stop.is_set():
+                    return
+                oldest = self._journal[0][0] if self._journal else None
+                if self._resync or oldest is None or oldest > following:
+                    # Replaced chain, or the entries it needs were dropped.
+                    frames = None
+                else:
+                    frames = [frame for _, _, frame in itertools.islice(
+                        self._journal, following - oldest, None)]
+            if frames is None:
+                following = self._sendSnapshot(sock) + 1
+                continue
+            for frame in frames:
+                self.sent_bytes += sendFrame(sock, frame)
+            self.sent += len(frames)
+            following = frames[-1][1] + 1
+
+    def _readAcks(self, sock):
+        while True:
+            try:
+                frame = recvFrame(sock)
+            except (socket.error, EOFError):
+                return
+            if frame is None:
+                return
+            if frame[0] != 'ack':
+                continue
+            now = time.time()
+            with self._cond:
+                self.acked = frame[1]
+                while self._journal and self._journal[0][0] <= self.acked:
+                    _, recorded, _ = self._journal.popleft()
+                    self.lag = now - recorded
+
+    def stats(self):
+        with self._cond:
+            elapsed = max(time.time() - self._start, 1e-6)
+            return ('connected=%s seq=%d acked=%d behind=%d lag=%.3fs '
+                    'sent=%d (%.1f/s) bytes=%d (%.0f/s) snapshots=%d '
+                    'dropped=%d' % (self.connected, self._seq, self.acked,
+                                    self._seq - self.acked, self.lag,
+                                    self.sent, self.sent / elapsed,
+                                    self.sent_bytes,
+                                    self.sent_bytes / elapsed,
+                                    self.snapshots, self.dropped))
+
+
+class Standby(object):
+    """Applies what a Primary sends.
+
+    on_snapshot(chunks, seen) replaces everything with a snapshot, given
+    as an iterable of item chunks; on_learn(batch) and on_seen(nick, entry)
+    apply journal entries.  They are called from the standby's thread.
+    """
+
+    def __init__(self, on_snapshot, on_learn, on_seen):
+        self.on_snapshot = on_snapshot
+        self.on_learn = on_learn
+        self.on_seen = on_seen
+
+        self.epoch = None
+        self.seq = 0
+        self._stop = Event()
+        self._worker = None
+        self._conn = None
+
+        # Statistics
+        self.connected = False
+        self.lost_at = None
+        self.snapshots = 0
+        self.applied = 0
+        self._start = time.time()
+
+    def serve(self, conn):
+        """Applies frames from one connection until it closes."""
+        self.connected = True
+        try:
+            sendFrame(conn, ('hello', self.epoch, self.seq))
+            chunks = []
+            while not self._stop.is_set():
+                frame = recvFrame(conn)
+                if frame is None:
+                    return
+                kind = frame[0]
+                if kind == 'chunk':
+                    chunks.append(frame[1])
+                    continue
+                elif kind == 'snapshot':
+                    _, seq, epoch, seen = frame
+                    self.on_snapshot(unpackChunks(chunks), seen)
+                    chunks = []
+                    self.epoch = epoch
+                    self.snapshots += 1
+                elif kind == 'learn':
+                    _, seq, batch = frame
+                    self.on_learn(batch)
+                    self.applied += 1
+                elif kind == 'seen':
+                    _, seq, (nick, entry) = frame
+                    self.on_seen(nick, entry)
+                    self.applied += 1
+                else:
+                    logging.error(ERROR + ('Unknown replication frame %s' %
+                                           kind))
+                    continue
+                self.seq = seq
+                sendFrame(conn, ('ack', seq))
+        finally:
+            self.connected = False
+            self.lost_at = time.time()
+
+    def start(self, listener):
+        self._worker = Thread(target=self._run, args=(listener,),
+                              name='standby')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def stop(self):
+        """Stops applying frames, waiting for the one in hand."""
+        self._stop.set()
+        conn = self._conn
+        if conn:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        if self._worker:
+            self._worker.join()
+
+    def _run(self, listener):
+        # Wake up now and then to notice stop().
+        listener.settimeout(1.0)
+        while not self._stop.is_set():
+            try:
+                conn, _ = listener.accept()
+            except socket.timeout:
+                continue
+            conn.settimeout(None)
+            self._conn = conn
+            try:
+                self.serve(conn)
+            except (socket.error, EOFError) as e:
+                logging.warning(WARNING + ('Lost the primary: %s' % e))
+            except Exception:
+                logging.exception(ERROR + 'Applying replication failed')
+            finally:
+                self._conn = None
+                conn.close()
+        listener.close()
+
+    def lost(self):
+        """Seconds since the primary went away, or None if it hasn't."""
+        if self.connected or self.lost_at is None:
+            return None
+        return time.time() - self.lost_at
+
+    def stats(self):
+        elapsed = max(time.time() - self._start, 1e-6)
+        return ('connected=%s seq=%d applied=%d (%.1f/s) snapshots=%d' %
+                (self.connected, self.seq, self.applied,
+                 self.applied / elapsed, self.snapshots))
@@ -0,0 +1,186 @@
+"""Replycache keeps pre-generated replies for frequently used seeds."""
+
+import heapq
+import logging
+import time
+
+from collections import OrderedDict
+from threading import Event, RLock, Thread
+
+from colortext import *
+
+
+class ReplyCache(object):
+    """A bounded cache of candidate replies keyed by seed context.
+
+    Seeds are counted as they are requested, and a background worker fills
+    in replies for the hottest ones whenever the bot has been idle for
+    idle_time seconds.  Entries are dropped when addLine changes their seed
+    context or once they are older than max_age, and the cache holds at most
+    max_seeds seeds, evicting the least recently used.
+    """
+
+    def __init__(self, chain, max_seeds=256, per_seed=4, hot_seeds=32,
+                 idle_time=2.0, max_age=600.0):
+        self.chain = chain
+        self.max_seeds = max_seeds
+        self.per_seed = per_seed
+        self.hot_seeds = hot_seeds
+        self.idle_time = idle_time
+        self.max_age = max_age
+
+        self._lock = RLock()
+        self._entries = OrderedDict() # seed -> [created, [replies]], LRU first
+        self._frequency = {} # seed -> request count
+        self._last_request = 0.0
+        # The seed the worker is generating a reply for outside the lock,
+        # and whether it was invalidated meanwhile.
+        self._refilling = None
+        self._refill_stale = False
+
+        self._stop = Event()
+        self._worker = None
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self.generation_time = 0.0
+        self.saved_time = 0.0
+
+        chain.addListener(self.invalidate)
+
+    def start(self):
+        self._worker = Thread(target=self._run, name='replycache')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def rebind(self, chain):
+        """Serves replies from chain instead, forgetting the old ones."""
+        with self._lock:
+            old, self.chain = self.chain, chain
+            self._entries.clear()
+            self._refill_stale = True
+        old.removeListener(self.invalidate)
+        chain.addListener(self.invalidate)
+
+    def _averageGenerationTime(self):
+        if not self.generated:
+            return 0.0
+        return self.generation_time / self.generated
+
+    def _generate(self, seed):
+        start = time.time()
+        reply = self.chain.respond(seed)
+        with self._lock:
+            self.generated += 1
+            self.generation_time += time.time() - start
+        return reply
+
+    def respond(self, seed, include_seed=False):
+        # Random seeds are never repeated, so there is nothing to cache.
+        if not seed:
+            return self.chain.respond(seed)
+
+        seed = tuple(seed)
+        reply = None
+        with self._lock:
+            self._last_request = time.time()
+            self._countRequest(seed)
+            entry = self._entries.get(seed)
+            if entry and entry[1]:
+                reply = entry[1].pop()
+                self._entries[seed] = self._entries.pop(seed)
+                self.hits += 1
+                self.saved_time += self._averageGenerationTime()
+            else:
+                self.misses += 1
+
+        if reply is None:
+            reply = self._generate(seed)
+        if include_seed:
+            reply = seed[0] + " " + seed[1] + " " + reply
+        return reply
+
+    def _countRequest(self, seed):
+        self._frequency[seed] = self._frequency.get(seed, 0) + 1
+        # Keep the counts bounded by periodically halving them and
+        # forgetting the seeds that fall to zero.
+        if len(self._frequency) > 4 * self.max_seeds:
+            for key in self._frequency.keys():
+                count = self._frequency[key] // 2
+                if count:
+                    self._frequency[key] = count
+                else:
+                    del self._frequency[key]
+
+    def invalidate(self, contexts):
+        with self._lock:
+            if not self._entries and self._refilling is None:
+                return
+            for context in contexts:
+                if context == self._refilling:
+                    self._refill_stale = True
+                if context in self._entries:
+                    del self._entries[context]
+
+    def _expire(self, now):
+        with self._lock:
+            for seed in self._entries.keys():
+                if now - self._entries[seed][0] > self.max_age:
+                    del self._entries[seed]
+
+    def _refill(self):
+        with self._lock:
+            hot = heapq.nlargest(self.hot_seeds, self._frequency.iteritems(),
+                                 key=lambda item: item[1])
+        for seed, _ in hot:
+            with self._lock:
+                entry = self._entries.get(seed)
+                if entry and len(entry[1]) >= self.per_seed:
+                    continue
+            if self._stop.is_set() or not self._isIdle():
+                return
+            with self._lock:
+                self._refilling = seed
+                self._refill_stale = False
+            try:
+                reply = self._generate(seed)
+            finally:
+                with self._lock:
+                    self._refilling = None
+            with self._lock:
+                if self._refill_stale:
+                    # addLine changed the seed's context while the reply
+                    # was being generated, so it may be out of date.
+                    continue
+                entry = self._entries.get(seed)
+                if entry is None:
+                    entry = [time.time(), []]
+                    self._entries[seed] = entry
+                    while len(self._entries) > self.max_seeds:
+                        self._entries.popitem(last=False)
+                entry[1].append(reply)
+
+    def _isIdle(self):
+        return time.time() - self._last_request >= self.idle_time
+
+    def _run(self):
+        while not self._stop.wait(self.idle_time):
+            self._expire(time.time())
+            if self._isIdle():
+                try:
+                    self._refill()
+                except Exception:
+                    logging.exception(ERROR + 'Reply cache refill failed')
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            hit_rate = 100.0 * self.hits / requests if requests else 0.0
+            return ('seeds=%d hits=%d misses=%d hit_rate=%.1f%% '
+                    'saved=%.3fs' % (len(self._entries), self.hits,
+                                     self.misses, hit_rate, self.saved_time))
@@ -0,0 +1,367 @@
+"""Sharedchain lets many bot processes generate from one copy of a chain.
+
+A loader publishes the chain once into a compact read-only file on a memory
+backed filesystem (/dev/shm by default), and every bot maps that file
+instead of unpickling a private copy, so the pages are shared between
+processes and nothing is copied on attach.  Publishing a new version
+atomically replaces the file; readers notice within CHECK_PERIOD seconds
+and map the new one, while replies already under way finish on the old.
+
+Layout, little-endian, with words and contexts referred to by index:
+  header      MAGIC, version, publish time, counts and section offsets
+  vocab       uint32 offset of each word plus an end offset, then the
+              words' bytes, sorted so words are found by binary search
+  contexts    uint32 (first, second) word id pairs, sorted
+  by_second   uint32 context indices sorted by (second, first)
+  starts      uint32 index of each context's first successor, plus an end
+  successor   uint32 word id of each successor
+  cumulative  uint32 running total of the counts within each context, so
+              picking a weighted successor is a binary search
+"""
+
+import array
+import contextlib
+import logging
+import mmap
+import os
+import random
+import struct
+import sys
+import time
+
+from threading import RLock, local
+
+import markov
+from colortext import *
+
+MAGIC = 'CHRKSHM1'
+VERSION = 1
+
+DEFAULT_PATH = '/dev/shm/charrak.chain'
+
+# How often (in seconds) readers look for a newly published version.
+CHECK_PERIOD = 5.0
+
+_HEADER = struct.Struct('<8sIdIII7Q')
+_UINT = struct.Struct('<I')
+_PAIR = struct.Struct('<II')
+
+
+def _section(values):
+    section = array.array('I', values)
+    if section.itemsize != 4:
+        section = array.array('L', values)
+    if sys.byteorder != 'little':
+        section.byteswap()
+    return section.tostring()
+
+
+def publish(path, db):
+    """Writes db in the shared layout, atomically replacing path.
+
+    Returns the number of contexts published.
+    """
+    vocab = set()
+    for key, successors in db.iteritems():
+        vocab.update(key)
+        vocab.update(word for _, word in successors)
+    vocab = sorted(vocab)
+    ids = dict((word, ii) for ii, word in enumerate(vocab))
+
+    offsets = [0]
+    for word in vocab:
+        offsets.append(offsets[-1] + len(word))
+
+    # Ids follow word order, so sorting the keys sorts them by id too.
+    keys = sorted(db)
+    contexts = []
+    starts = [0]
+    successor = []
+    cumulative = []
+    for key in keys:
+        contexts.append(ids[key[0]])
+        contexts.append(ids[key[1]])
+        running = 0
+        for count, word in db[key]:
+            running += count
+            successor.append(ids[word])
+            cumulative.append(running)
+        starts.append(len(successor))
+    by_second = sorted(xrange(len(keys)),
+                       key=lambda ii: (contexts[2 * ii + 1], contexts[2 * ii]))
+
+    try:
+        sections = [_section(offsets), ''.join(vocab), _section(contexts),
+                    _section(by_second), _section(starts),
+                    _section(successor), _section(cumulative)]
+    except OverflowError:
+        raise ValueError('Chain is too large to publish')
+
+    section_offsets = []
+    offset = _HEADER.size
+    for section in sections:
+        section_offsets.append(offset)
+        offset += len(section)
+
+    temp = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp, 'wb') as shared:
+        shared.write(_HEADER.pack(MAGIC, VERSION, time.time(), len(vocab),
+                                  len(keys), len(successor),
+                                  *section_offsets))
+        for section in sections:
+            shared.write(section)
+    os.rename(temp, path)
+    return len(keys)
+
+
+def _bisect(lo, hi, below):
+    # The first index in [lo, hi) for which below() is false.
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if below(mid):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class _View(object):
+    """One published version, mapped read-only."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as shared:
+            stat = os.fstat(shared.fileno())
+            self.identity = (stat.st_ino, stat.st_mtime, stat.st_size)
+            self.map = mmap.mmap(shared.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < _HEADER.size:
+            raise ValueError('"%s" is truncated' % path)
+        (magic, version, self.published, self.words, self.contexts,
+         self.transitions, self._offsets, self._vocab, self._pairs,
+         self._by_second, self._starts, self._successor,
+         self._cumulative) = _HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            raise ValueError('"%s" is not a shared chain' % path)
+        if version != VERSION:
+            raise ValueError('Unsupported shared chain version %d' % version)
+
+    def _uint(self, section, ii):
+        return _UINT.unpack_from(self.map, section + 4 * ii)[0]
+
+    def word(self, wid):
+        start, end = _PAIR.unpack_from(self.map, self._offsets + 4 * wid)
+        return self.map[self._vocab + start:self._vocab + end]
+
+    def wordId(self, word):
+        wid = _bisect(0, self.words, lambda ii: self.word(ii) < word)
+        if wid < self.words and self.word(wid) == word:
+            return wid
+        return None
+
+    def pair(self, ii):
+        return _PAIR.unpack_from(self.map, self._pairs + 8 * ii)
+
+    def contextWords(self, ii):
+        first, second = self.pair(ii)
+        return (self.word(first), self.word(second))
+
+    def find(self, bigram):
+        """Returns the index of bigram's context, or None."""
+        first = self.wordId(bigram[0])
+        second = self.wordId(bigram[1])
+        if first is None or second is None:
+            return None
+        key = (first, second)
+        ii = _bisect(0, self.contexts, lambda ii: self.pair(ii) < key)
+        if ii < self.contexts and self.pair(ii) == key:
+            return ii
+        return None
+
+    def sampleContaining(self, wid, samples):
+        """Returns up to samples random indices of contexts containing wid.
+
+        The contexts starting with wid and the by_second entries ending
+        with it are two ranges found by binary search, so nothing is built
+        per context.  A context with wid in both places can be drawn from
+        either.
+        """
+        lo = _bisect(0, self.contexts, lambda ii: self.pair(ii)[0] < wid)
+        hi = _bisect(lo, self.contexts, lambda ii: self.pair(ii)[0] <= wid)
+
+        def second(ii):
+            return self.pair(self._uint(self._by_second, ii))[1]
+        lo2 = _bisect(0, self.contexts, lambda ii: second(ii) < wid)
+        hi2 = _bisect(lo2, self.contexts, lambda ii: second(ii) <= wid)
+
+        firsts = hi - lo
+        total = firsts + hi2 - lo2
+        found = []
+        for _ in xrange(min(samples, total)):
+            which = random.randrange(total)
+            if which < firsts:
+                found.append(lo + which)
+            else:
+                found.append(self._uint(self._by_second,
+                                        lo2 + which - firsts))
+        return found
+
+    def successorRange(self, ii):
+        return _PAIR.unpack_from(self.map, self._starts + 4 * ii)
+
+    def successors(self, ii):
+        lo, hi = self.successorRange(ii)
+        values = []
+        previous = 0
+        for jj in xrange(lo, hi):
+            running = self._uint(self._cumulative, jj)
+            values.append([running - previous,
+                           self.word(self._uint(self._successor, jj))])
+            previous = running
+        return values
+
+    def sample(self, ii):
+        lo, hi = self.successorRange(ii)
+        if lo == hi:
+            return None
+        # The same draw as markov.pickWeighted, over the running totals.
+        total = self._uint(self._cumulative, hi - 1)
+        which = random.randint(1, total)
+        jj = _bisect(lo, hi,
+                     lambda jj: self._uint(self._cumulative, jj) < which)
+        return self.word(self._uint(self._successor, jj))
+
+
+class SharedChain(markov.BaseChain):
+    """A read-only chain generating from a published shared chain.
+
+    Until something is published at path the chain is empty.  It can't
+    learn, so bots using it must be read-only.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, check_period=CHECK_PERIOD):
+        self.path = path
+        self.check_period = check_period
+        self.listeners = []
+        self._lock = RLock()
+        self._view = None
+        self._checked = 0.0
+        # The view the current thread's reply is walking, if any.
+        self._pinned = local()
+        self._current()
+
+    def _refresh(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            # Nothing published (yet); keep whatever we have.
+            return
+        identity = (stat.st_ino, stat.st_mtime, stat.st_size)
+        if self._view and self._view.identity == identity:
+            return
+        try:
+            view = _View(self.path)
+        except (IOError, OSError, ValueError) as e:
+            logging.error(ERROR + ("Unable to map shared chain '%s': %s" %
+                                   (self.path, e)))
+            return
+        # Replies under way hold the old view, which stays mapped until
+        # they finish.
+        self._view = view
+        logging.info(GREEN + ("Mapped shared chain '%s' published %s: "
+                              "%d contexts" % (self.path,
+                                               time.ctime(view.published),
+                                               view.contexts)))
+
+    def _current(self):
+        view = getattr(self._pinned, 'view', None)
+        if view is not None:
+            return view
+        with self._lock:
+            now = time.time()
+            if now - self._checked >= self.check_period:
+                self._checked = now
+                self._refresh()
+            return self._view
+
+    def addListener(self, listener):
+        self.listeners.append(listener)
+
+    def removeListener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    @contextlib.contextmanager
+    def walking(self):
+        # Walk the whole reply on one view, even if a new version is
+        # published part way through.
+        if getattr(self._pinned, 'view', None) is not None:
+            yield
+            return
+        self._pinned.view = self._current()
+        try:
+            yield
+        finally:
+            self._pinned.view = None
+
+    def close(self):
+        with self._lock:
+            self._view = None
+
+    def hasContext(self, bigram):
+        view = self._current()
+        return view is not None and view.find(bigram) is not None
+
+    def size(self):
+        view = self._current()
+        if view is None:
+            return 0
+        return view.contexts
+
+    def randomContext(self):
+        view = self._current()
+        if view is None or not view.contexts:
+            return None
+        return view.contextWords(random.randint(0, view.contexts - 1))
+
+    def rankSeeds(self, words):
+        """Returns (score, bigrams) for the best seeds for words."""
+        view = self._current()
+        if view is None:
+            return 0, []
+        wordset = set(words)
+        best = [bg for bg in markov.bigrams(" ".join(words))
+                if view.find(bg) is not None]
+        if best:
+            return markov.VERBATIM_SCORE, best
+
+        best_score = 0
+        for word in wordset:
+            wid = view.wordId(word)
+            if not word or wid is None:
+                continue
+            for ii in view.sampleContaining(wid, markov.SEED_SAMPLES):
+                bigram = view.contextWords(ii)
+                score = len(set(bigram) & wordset)
+                if score > best_score:
+                    best, best_score = [bigram], score
+                elif score == best_score:
+                    best.append(bigram)
+        return best_score, best
+
+    def successors(self, bigram):
+        """Returns the [[count, word], ...] list for bigram."""
+        view = self._current()
+        if view is None:
+            return None
+        ii = view.find(bigram)
+        if ii is None:
+            return None
+        return view.successors(ii)
+
+    def sampleNext(self, bigram):
+        view = self._current()
+        if view is None:
+            return None
+        ii = view.find(bigram)
+        if ii is None:
+            return None
+        return view.sample(ii)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""Runs a Primary and a local Standby over socket pairs.
+
+    python -m unittest test_replication
+"""
+import socket
+import threading
+import time
+import unittest
+
+import markov
+import replication
+
+LINES = ['the cat sat on the mat', 'the dog sat on the log',
+         'a cat and a dog sat together on the mat']
+
+
+def learn(chain, batch):
+    for (_, _, text), count in batch:
+        for _ in range(count):
+            chain.addLine(text)
+
+
+class Pair(object):
+    """A primary chain and seen db replicated to a standby copy."""
+
+    def __init__(self):
+        self.chain = markov.MarkovChain('/nonexistent', load=False)
+        self.seen = {}
+        self.lock = threading.RLock()
+        self.sockets = []
+
+        self.copy = markov.MarkovChain('/nonexistent', load=False)
+        self.copy_seen = {}
+
+        self.primary = replication.Primary(self.connect, self.snapshot,
+                                           retry=0.05)
+        self.standby = replication.Standby(self.applySnapshot,
+                                           lambda batch: learn(self.copy,
+                                                               batch),
+                                           self.copy_seen.__setitem__)
+
+    def connect(self):
+        if not self.sockets:
+            raise socket.error('No standby')
+        return self.sockets.pop(0)
+
+    def snapshot(self):
+        with self.lock:
+            seq = self.primary.position()
+            items = [(key, map(list, successors))
+                     for key, successors in self.chain.db.iteritems()]
+            seen = dict(self.seen)
+        return seq, replication.packChunks(items, 2), seen
+
+    def applySnapshot(self, chunks, seen):
+        self.copy.replaceDatabase(chunks)
+        self.copy_seen.clear()
+        self.copy_seen.update(seen)
+
+    def learn(self, text):
+        with self.lock:
+            self.chain.addLine(text)
+            self.primary.record('learn', [(('#c', 'bob', text), 1)])
+
+    def sight(self, nick, entry):
+        with self.lock:
+            self.seen[nick] = entry
+            self.primary.record('seen', (nick, entry))
+
+    def attach(self):
+        """Connects the standby over a new socket pair."""
+        ours, theirs = socket.socketpair()
+        self.sockets.append(ours)
+        thread = threading.Thread(target=self.serve, args=(theirs,))
+        thread.daemon = True
+        thread.start()
+        return theirs, thread
+
+    def serve(self, conn):
+        try:
+            self.standby.serve(conn)
+        except (socket.error, EOFError):
+            pass
+
+    def converge(self, timeout=10.0):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.standby.seq == self.primary.position():
+                return True
+            time.sleep(0.01)
+        return False
+
+
+class ReplicationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pair = Pair()
+
+    def tearDown(self):
+        self.pair.primary.stop()
+
+    def assertReplicated(self):
+        self.assertTrue(self.pair.converge())
+        self.assertEqual(self.pair.copy.db, self.pair.chain.db)
+        self.assertEqual(self.pair.copy_seen, self.pair.seen)
+
+    def testSnapshotThenJournal(self):
+        pair = self.pair
+        for line in LINES:
+            pair.learn(line)
+        pair.sight('bob', ['#c', 1.0, 'hi'])
+        pair.attach()
+        pair.primary.start()
+        self.assertReplicated()
+
+        for line in LINES:
+            pair.learn(line + ' again')
+        pair.sight('alice', ['#c', 2.0, 'hello'])
+        self.assertReplicated()
+        self.assertEqual(pair.standby.snapshots, 1)
+
+    def testResumesAfterDrop(self):
+        pair = self.pair
+        pair.learn(LINES[0])
+        conn, thread = pair.attach()
+        pair.primary.start()
+        self.assertReplicated()
+
+        conn.shutdown(socket.SHUT_RDWR)
+        thread.join(5.0)
+        for line in LINES[1:]:
+            pair.learn(line)
+        pair.attach()
+        self.assertReplicated()
+        # The journal still held what the standby missed.
+        self.assertEqual(pair.standby.snapshots, 1)
+
+    def testResyncSendsSnapshot(self):
+        pair = self.pair
+        pair.learn(LINES[0])
+        pair.attach()
+        pair.primary.start()
+        self.assertReplicated()
+
+        with pair.lock:
+            pair.chain.replaceDatabase([[(('x', 'y'), [[1, 'z']])]])
+            pair.primary.resync()
+        pair.learn(LINES[1])
+        self.assertReplicated()
+        self.assertEqual(pair.standby.snapshots, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,18 +3,39 @@ import sys
 import markov
 import argparse
 import datetime
+import glob
+import gzip
+import hashlib
+import ingestfilter
+import json
+import logger
+import os
+import time
 import dateutil
 import dateutil.parser
 
 #
 
 ARGPARSER = argparse.ArgumentParser(description='Process debug logs.')
-ARGPARSER.add_argument('files', nargs='?', type=argparse.FileType('r'),
-                       default=sys.stdin)
+ARGPARSER.add_argument('files', nargs='*',
+                       help='Log files or globs, plain or .gz (default stdin). '
+                       'Files named *.jsonl* are read as corpus logs.')
 ARGPARSER.add_argument('--before', dest='beforedate', default=datetime.date.max)
 ARGPARSER.add_argument('--after', dest='afterdate', default=datetime.date.min)
 ARGPARSER.add_argument('--db', dest='db', default='./traineddb')
 ARGPARSER.add_argument('--nick', dest='nick', default='charrak')
+ARGPARSER.add_argument('--dedup_window', dest='dedup_window', type=float,
+                       default=600)
+ARGPARSER.add_argument('--speaker_rate', dest='speaker_rate', type=int,
+                       default=10)
+ARGPARSER.add_argument('--checkpoint', dest='checkpoint', default=None,
+                       help='Where to remember what has been trained on '
+                       '(default: <db>.checkpoint)')
+ARGPARSER.add_argument('--full', dest='full', action='store_true',
+                       help='Ignore the checkpoint and existing db and retrain '
+                       'on everything')
+ARGPARSER.add_argument('--corpus', dest='corpus', action='store_true',
+                       help='Read stdin as a corpus log')
 ARGS = ARGPARSER.parse_args()
 
 #
@@ -25,36 +46,199 @@ AFTER_DATE = str(ARGS.afterdate)
 BEFORE = dateutil.parser.parse(BEFORE_DATE)
 AFTER = dateutil.parser.parse(AFTER_DATE)
 
-MC = markov.MarkovChain(str(ARGS.db))
 
-for line in ARGS.files:
-    time_text = line.split(':')
-    if len(time_text) < 3:
-        continue
+def epoch(when, default):
+    try:
+        return time.mktime(when.timetuple())
+    except (OverflowError, ValueError):
+        return default
 
-    timestamp = (time_text[0] + ":" + time_text[1]+ ":" +
-                 time_text[2].split(',')[0])
-    cur_time = dateutil.parser.parse(timestamp)
+BEFORE_TIME = epoch(BEFORE, float('inf'))
+AFTER_TIME = epoch(AFTER, float('-inf'))
 
-    if cur_time > BEFORE or cur_time < AFTER:
-        continue
+CHECKPOINT = ARGS.checkpoint or str(ARGS.db) + '.checkpoint'
 
-    words = line.split(':')
+# A full retrain starts over rather than adding to the existing counts.
+MC = markov.MarkovChain(str(ARGS.db), load=not ARGS.full)
+SESSION = MC.ingestSession()
+FILTER = ingestfilter.IngestFilter(
+    window=ARGS.dedup_window if ARGS.dedup_window > 0 else None,
+    rate=ARGS.speaker_rate if ARGS.speaker_rate > 0 else None)
 
-    if words[3] == 'INFO' or words[3] == 'WARNING' or words[3] == 'ERROR':
-        continue
 
-    # '20:1b:5b:39:36:6d:' nick '1b:5b:30:6d:20'
-    who = words[4][6:len(words[4])-5]
+def openLog(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
 
-    if who == str(ARGS.nick):
-        continue
 
-    color_what = ''.join(words[5:])
-    what = color_what[6:len(color_what)-5]
+def identify(logfile):
+    # Rotation renames logs and archiving compresses them, but their
+    # content starts the same, so the first line identifies a log.
+    first = logfile.readline()
+    logfile.seek(0)
+    return hashlib.sha1(first).hexdigest()
 
-    if not what.isspace() and len(what) > 0:
-        MC.addLine(what)
 
-MC.saveDatabase()
+def loadCheckpoint():
+    if ARGS.full:
+        return {'files': {}, 'last_time': None}
+    try:
+        with open(CHECKPOINT) as f:
+            checkpoint = json.load(f)
+    except IOError:
+        return {'files': {}, 'last_time': None}
+    # Older checkpoints kept the time as a date string.
+    if isinstance(checkpoint.get('last_time'), basestring):
+        checkpoint['last_time'] = epoch(
+            dateutil.parser.parse(checkpoint['last_time']), None)
+    return checkpoint
+
 
+def saveCheckpoint(checkpoint):
+    # Write then rename, so an interrupted run leaves the old checkpoint.
+    temp = CHECKPOINT + '.tmp'
+    with open(temp, 'w') as f:
+        json.dump(checkpoint, f, indent=1)
+    os.rename(temp, CHECKPOINT)
+
+
+def logPaths():
+    paths = set()
+    for pattern in ARGS.files:
+        paths.update(glob.glob(pattern))
+    # Oldest first, so the last timestamp only moves forward.
+    return sorted(paths, key=os.path.getmtime)
+
+
+def readLines(logfile, offset):
+    """Yields (line, offset after it) for the complete lines from offset."""
+    logfile.seek(offset)
+    for line in iter(logfile.readline, ''):
+        # A partial line is still being written; leave it for next time.
+        if not line.endswith('\n'):
+            return
+        offset += len(line)
+        yield line, offset
+
+
+def train(lines, since):
+    """Learns from lines of a debug log, returning the last time seen.
+
+    Times are in seconds since the epoch.
+    """
+    last_time = since
+    for line in lines:
+        time_text = line.split(':')
+        if len(time_text) < 3:
+            continue
+
+        timestamp = (time_text[0] + ":" + time_text[1]+ ":" +
+                     time_text[2].split(',')[0])
+        cur_time = dateutil.parser.parse(timestamp)
+        when = time.mktime(cur_time.timetuple())
+
+        if since is not None and when <= since:
+            continue
+        last_time = when
+
+        if cur_time > BEFORE or cur_time < AFTER:
+            continue
+
+        words = line.split(':')
+
+        if words[3] == 'INFO' or words[3] == 'WARNING' or words[3] == 'ERROR':
+            continue
+
+        # '20:1b:5b:39:36:6d:' nick '1b:5b:30:6d:20'
+        who = words[4][6:len(words[4])-5]
+
+        if who == str(ARGS.nick):
+            continue
+
+        color_what = ''.join(words[5:])
+        what = color_what[6:len(color_what)-5]
+
+        if not what.isspace() and len(what) > 0:
+            if FILTER.allow(what, who, when):
+                SESSION.addLine(what)
+    return last_time
+
+
+def trainCorpus(lines, since):
+    """Learns from lines of a corpus log, returning the last time seen."""
+    last_time = since
+    for when, _, who, what in logger.readCorpus(lines):
+        if since is not None and when <= since:
+            continue
+        last_time = when
+
+        if when > BEFORE_TIME or when < AFTER_TIME:
+            continue
+
+        if who == str(ARGS.nick):
+            continue
+
+        if not what.isspace() and len(what) > 0:
+            if FILTER.allow(what, who, when):
+                SESSION.addLine(what)
+    return last_time
+
+
+def isCorpus(path):
+    return '.jsonl' in os.path.basename(path)
+
+
+def trainFile(path, checkpoint, last_time):
+    with openLog(path) as logfile:
+        identity = identify(logfile)
+        known = checkpoint['files'].get(identity)
+        # Logs already partly trained on resume where they left off; the
+        # timestamp only guards logs we have never seen.
+        since = None
+        if known:
+            offset = known['offset']
+        else:
+            offset = 0
+            since = last_time
+        progress = {'offset': offset}
+
+        def lines():
+            for line, end in readLines(logfile, offset):
+                progress['offset'] = end
+                yield line
+
+        if isCorpus(path):
+            newest = trainCorpus(lines(), since)
+        else:
+            newest = train(lines(), since)
+        checkpoint['files'][identity] = {'name': path,
+                                         'offset': progress['offset']}
+        sys.stderr.write('%s: trained from byte %d to %d\n' %
+                         (path, offset, progress['offset']))
+    return newest
+
+
+if ARGS.files:
+    CHECKPOINTED = loadCheckpoint()
+    LAST_TIME = CHECKPOINTED.get('last_time')
+
+    NEWEST = None
+    for path in logPaths():
+        newest = trainFile(path, CHECKPOINTED, LAST_TIME)
+        if newest is not None and (NEWEST is None or newest > NEWEST):
+            NEWEST = newest
+    if NEWEST is not None and (LAST_TIME is None or NEWEST > LAST_TIME):
+        CHECKPOINTED['last_time'] = NEWEST
+else:
+    CHECKPOINTED = None
+    if ARGS.corpus:
+        trainCorpus(sys.stdin, None)
+    else:
+        train(sys.stdin, None)
+
+SESSION.flush()
+MC.saveDatabase()
+if CHECKPOINTED is not None:
+    saveCheckpoint(CHECKPOINTED)
+sys.stderr.write(FILTER.stats() + '\n')
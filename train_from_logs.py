@@ -1,19 +1,41 @@
 #!/usr/bin/env python
 import sys
+import bulkcount
+import ingestfilter
+import logger
 import markov
 import string
 
 
-FILES = sys.argv[1:]
+# --bulk counts the whole corpus with numpy, which is much faster for full
+# retrains and learns exactly the same counts.
+BULK = '--bulk' in sys.argv[1:]
+FILES = [arg for arg in sys.argv[1:] if arg != '--bulk']
 if not FILES:
     FILES = ["/dev/stdin"]
 
 
 MC = markov.MarkovChain("./traineddb")
+if BULK:
+    SESSION = bulkcount.BulkSession(MC)
+else:
+    SESSION = MC.ingestSession()
+# These logs carry no usable timestamps, so only drop repeats among the
+# most recent lines and don't rate limit.
+FILTER = ingestfilter.IngestFilter(window=None, rate=None)
 
 for fi in FILES:
     f = open(fi)
 
+    # corpus logs written by the bot need no parsing
+    if '.jsonl' in fi:
+        for _, _, who, text in logger.readCorpus(f):
+            if who != "charrak" and not text.isspace() and len(text) > 0 \
+                    and FILTER.allow(text):
+                SESSION.addLine(text)
+        f.close()
+        continue
+
     for line in f:
         words = line.split()
         # we have to handle charrak's replies specially (we want to ignore them)
@@ -35,9 +57,11 @@ for fi in FILES:
 
             text = " ".join(words[3:])
             text = text.lstrip()
-            if not text.isspace() and len(text) > 0:
-                MC.addLine(text)
+            if not text.isspace() and len(text) > 0 and FILTER.allow(text):
+                SESSION.addLine(text)
 
     f.close()
 
+SESSION.flush()
 MC.saveDatabase()
+sys.stderr.write(FILTER.stats() + '\n')